@@ -0,0 +1,219 @@
+"""Drives /gamedata against the fake LoL API at several concurrency levels.
+
+Reports throughput, latency percentiles, upstream calls per request and cache
+hit ratios for each level, and compares them with the stored baselines so
+regressions show up. Latency and throughput are compared relative to the median
+latency of a single client in the same run, which cancels out most of the speed
+of the machine the baselines were recorded on.
+
+Run from the repository root:
+    python benchmarks/load.py [--requests 300] [--concurrency 1,8,32] [--runs 3] [--save]"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, ROOT)
+BASELINE_FILE = os.path.join(ROOT, "benchmarks", "baseline.json")
+
+#Median milliseconds and sigma of the log-normal latency of each fake endpoint
+LATENCY = {"summoner" : (30, 0.3), "matchlist" : (40, 0.3), "match" : (60, 0.4),
+           "champions" : (80, 0.2), "champion" : (30, 0.3), "mastery" : (30, 0.5)}
+SUMMONERS = 200 #Distinct summoners requested, a few of them much more often
+REGION = "EUW"
+
+#Allowed change from the baseline before flagging a regression
+TOLERANCE = {"throughput_rps" : -0.30, "p95_ms" : 0.50, "upstream_calls_per_request" : 0.10}
+REFERENCE_LEVEL = "1" #Concurrency whose median latency scales latency and throughput
+
+import requests
+from mocks.fake_riot import FakeRiot
+from werkzeug.serving import make_server
+
+def percentile(values, fraction):
+    """Returns the value at the fraction (0 to 1) of the sorted values"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summoner_names(count, seed):
+    """Picks summoner names with a skewed popularity, like real traffic"""
+    rnd = random.Random(seed)
+    return ["summoner{n}".format(n=int(SUMMONERS * rnd.random() ** 3)) for _ in range(count)]
+
+def drive(url, names, concurrency):
+    """Requests /gamedata for every name with concurrency parallel clients.
+    Returns the latency of each request in ms and the number of errors."""
+    latencies = []
+    errors = []
+    pending = list(reversed(names))
+    lock = threading.Lock()
+
+    def client():
+        """Requests names until there are none left"""
+        session = requests.Session()
+        while True:
+            with lock:
+                if not pending:
+                    return
+                name = pending.pop()
+            start = time.time()
+            resp = session.get(url, params={"region" : REGION, "summoner" : name})
+            elapsed = (time.time() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if resp.status_code != 200:
+                    errors.append(resp.status_code)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, len(errors)
+
+def cache_stats(cache):
+    """Returns the counters of the in-memory caches"""
+    return dict((name, getattr(cache, name).stats())
+                for name in ["ACCOUNTS", "MATCHES", "MASTERIES", "RESPONSES"])
+
+def hit_ratios(before, after):
+    """Returns the hit ratio of each cache between two snapshots of its counters"""
+    ratios = {}
+    for name in after:
+        hits = after[name]["hits"] - before[name]["hits"]
+        misses = after[name]["misses"] - before[name]["misses"]
+        ratios[name.lower()] = round(float(hits) / (hits + misses), 3) if hits + misses else None
+    return ratios
+
+def run_level(app_url, fake, modules, directory, names, concurrency):
+    """Runs one concurrency level from cold caches"""
+    cache, matchstore = modules
+    for name in ["ACCOUNTS", "MATCHES", "MASTERIES", "RESPONSES"]:
+        getattr(cache, name).clear()
+    matchstore.MATCHES = matchstore.MatchStore(tempfile.mkdtemp(dir=directory), 10 ** 9)
+    for endpoint in fake.calls:
+        fake.calls[endpoint] = 0
+
+    before = cache_stats(cache)
+    start = time.time()
+    latencies, errors = drive(app_url, names, concurrency)
+    elapsed = time.time() - start
+
+    return {"concurrency" : concurrency,
+            "requests" : len(latencies),
+            "errors" : errors,
+            "throughput_rps" : round(len(latencies) / elapsed, 1),
+            "p50_ms" : round(percentile(latencies, 0.50), 1),
+            "p95_ms" : round(percentile(latencies, 0.95), 1),
+            "p99_ms" : round(percentile(latencies, 0.99), 1),
+            "upstream_calls_per_request" : round(float(fake.total_calls()) / len(latencies), 2),
+            "cache_hit_ratio" : hit_ratios(before, cache_stats(cache))}
+
+def median_result(runs):
+    """Combines the runs of a level, keeping the median of each number"""
+    result = dict(runs[0])
+    for metric, value in runs[0].items():
+        if isinstance(value, (int, float)):
+            result[metric] = sorted(run[metric] for run in runs)[len(runs) // 2]
+    return result
+
+def relative(result, reference):
+    """Returns the metrics of a level with latency and throughput scaled by the median
+    latency of a single client: latency in multiples of it, throughput in requests per
+    such median"""
+    scaled = dict(result)
+    if reference is not None:
+        scaled["p95_ms"] = result["p95_ms"] / reference["p50_ms"]
+        scaled["throughput_rps"] = result["throughput_rps"] * reference["p50_ms"]
+    return scaled
+
+def compare(results, baselines):
+    """Prints the change of each metric from its baseline, returns the regressions.
+    Without a single client level in both runs, metrics are compared as they are."""
+    regressions = []
+    levels = dict((str(result["concurrency"]), result) for result in results)
+    if REFERENCE_LEVEL in levels and REFERENCE_LEVEL in baselines:
+        references = (levels[REFERENCE_LEVEL], baselines[REFERENCE_LEVEL])
+    else:
+        references = (None, None)
+    for result in results:
+        baseline = baselines.get(str(result["concurrency"]))
+        if baseline is None:
+            continue
+        scaled_result = relative(result, references[0])
+        scaled_baseline = relative(baseline, references[1])
+        for metric, tolerance in sorted(TOLERANCE.items()):
+            new, old = scaled_result[metric], scaled_baseline[metric]
+            change = (new - old) / float(old or 1)
+            regressed = change < tolerance if tolerance < 0 else change > tolerance
+            print "  c={c} {metric}: {old} -> {new} ({change:+.0%}){flag}".format(
+                c=result["concurrency"], metric=metric, old=baseline[metric],
+                new=result[metric], change=change, flag=" REGRESSION" if regressed else "")
+            if regressed:
+                regressions.append((result["concurrency"], metric))
+    return regressions
+
+def main():
+    """Runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="runs of each level, the median of each metric is kept")
+    parser.add_argument("--save", action="store_true", help="store the results as baselines")
+    args = parser.parse_args()
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    directory = tempfile.mkdtemp()
+    fake = FakeRiot(latency=LATENCY, seed=1)
+    fake_server = fake.serve()
+    os.environ["API_BASE_URL"] = "http://127.0.0.1:{port}/{{queryRegion}}/lol".format(
+        port=fake_server.server_port)
+    os.environ["API_KEY"] = "LoremIpsum"
+    os.environ["APP_RATE_LIMITS"] = "100000:1"
+
+    import app
+    import cache
+    import matchstore
+    cache.CHAMPIONS = {}
+    cache.CHAMPIONS_STORE = cache.AppendOnlyStore(os.path.join(directory, "champions.jsonl"))
+    app_server = make_server("127.0.0.1", 0, app.APP, threaded=True)
+    app_thread = threading.Thread(target=app_server.serve_forever)
+    app_thread.daemon = True
+    app_thread.start()
+    app_url = "http://127.0.0.1:{port}/gamedata".format(port=app_server.server_port)
+
+    names = summoner_names(args.requests, seed=1)
+    results = []
+    try:
+        for concurrency in [int(level) for level in args.concurrency.split(",")]:
+            result = median_result([run_level(app_url, fake, (cache, matchstore), directory,
+                                              names, concurrency) for _ in range(args.runs)])
+            print json.dumps(result, sort_keys=True)
+            results.append(result)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.save:
+        with open(BASELINE_FILE, "w") as baseline_file:
+            json.dump(dict((str(result["concurrency"]), result) for result in results),
+                      baseline_file, indent=2, sort_keys=True, separators=(",", ": "))
+        print "Saved baselines to " + BASELINE_FILE
+        return 0
+
+    if not os.path.exists(BASELINE_FILE):
+        return 0
+    with open(BASELINE_FILE, "r") as baseline_file:
+        regressions = compare(results, json.load(baseline_file))
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
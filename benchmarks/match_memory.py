@@ -0,0 +1,61 @@
+"""Compares the peak memory of decoding whole match payloads against the selective
+streaming parse, holding as many matches as concurrent requests would.
+
+Run from the repository root: python benchmarks/match_memory.py [matches]"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+MOCK_MATCH = os.path.join(ROOT, "mocks", "mockmatch.json")
+CHUNK_SIZE = 16384
+
+def peak_rss_mb():
+    """Returns the peak resident memory of this process in MB"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return usage / (1024.0 * 1024.0)
+    return usage / 1024.0
+
+def chunks_of(raw):
+    """Splits the raw payload as it would arrive from the network"""
+    for start in xrange(0, len(raw), CHUNK_SIZE):
+        yield raw[start:start + CHUNK_SIZE]
+
+def run(method, matches):
+    """Parses the same payload `matches` times, keeping every result alive"""
+    import matchparser
+    import cache
+    with open(MOCK_MATCH, "rb") as mock:
+        raw = mock.read()
+
+    baseline = peak_rss_mb()
+    start = time.time()
+    kept = []
+    for _ in xrange(matches):
+        if method == "full":
+            kept.append(json.loads("".join(chunks_of(raw))))
+        else:
+            kept.append(matchparser.parse_match(chunks_of(raw)))
+    elapsed = time.time() - start
+
+    print json.dumps({"method" : method, "matches" : matches,
+                      "peak_rss_mb" : round(peak_rss_mb() - baseline, 1),
+                      "retained_kb_per_match" : round(cache.approximate_size(kept[0]) / 1024.0, 1),
+                      "ms_per_match" : round(elapsed * 1000 / matches, 2)})
+
+def main():
+    """Runs each method in a fresh process so their peaks don't mix"""
+    matches = sys.argv[1] if len(sys.argv) > 1 else "200"
+    for method in ["full", "selective"]:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), "--run", method, matches])
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--run":
+        run(sys.argv[2], int(sys.argv[3]))
+    else:
+        main()
@@ -0,0 +1,16 @@
+"""Gunicorn settings for serving the application with several worker processes.
+Every worker has its own in-memory caches, shared through SHARED_CACHE_FILE, where
+the workers also share the token buckets of the LoL API rate limits."""
+import multiprocessing
+import os
+
+os.environ.setdefault("SHARED_CACHE_FILE",
+                      os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "cache", "shared.sqlite"))
+
+bind = os.getenv("WEB_BIND", "0.0.0.0:80")
+workers = int(os.getenv("WEB_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "gthread"
+threads = int(os.getenv("WEB_THREADS", 8))
+timeout = int(os.getenv("WEB_TIMEOUT", 60))
+keepalive = 5
@@ -0,0 +1,235 @@
+"""Offline stand-in for the LoL API, serving data drawn from the mock match.
+
+Summoners not in the mock match play one of MATCH_VARIANTS other matches, each
+with its own participants: champions drawn from a catalog of CHAMPIONS champions
+and summoners of their own, so lookups fan out like they do with real traffic.
+
+Latency and errors can be configured per endpoint, and an application rate
+limit is enforced with the same headers the real API sends. It can be used in
+process through request_get (as a replacement for LoL.request_get) or served
+over HTTP with serve()."""
+import json
+import math
+import os
+import random
+import threading
+import time
+import urlparse
+import zlib
+from flask import Flask, Response, request
+from werkzeug.serving import make_server
+
+MOCKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = ["summoner", "matchlist", "match", "champions", "champion", "mastery"]
+MISSING_PREFIX = "missing" #Summoners whose name starts with it don't exist
+NO_GAMES_PREFIX = "nogames" #Summoners whose name starts with it have no matches
+MATCH_VARIANTS = 50 #Distinct matches played by summoners not in the mock match
+CHAMPIONS = 140 #Champion IDs from 1 are in the catalog, along with the mock match ones
+
+def load_fixtures():
+    """Loads the mock match and the champion names and masteries of its response"""
+    with open(os.path.join(MOCKS_DIR, "mockmatch.json"), "rb") as mock:
+        raw_match = mock.read()
+    with open(os.path.join(MOCKS_DIR, "mockresponse.json"), "rb") as mock:
+        participants = json.loads(mock.read())["participants"]
+    match = json.loads(raw_match)
+    champions = dict((part["championId"], part["championName"]) for part in participants)
+    masteries = dict((part["championId"], part["championMastery"]) for part in participants)
+    accounts = dict((player["player"]["summonerName"], player["player"]["accountId"])
+                    for player in match["participantIdentities"])
+    return raw_match, match["gameId"], champions, masteries, accounts
+
+class FakeRiot(object):
+    """Fake LoL API.
+    latency maps endpoints to a (median ms, sigma) log-normal distribution, errors
+    maps endpoints to {status code: probability}, and app_rate_limit is a limit
+    like "100:1" enforced across all endpoints."""
+
+    def __init__(self, latency=None, errors=None, app_rate_limit="100000:1", seed=None):
+        self.latency = latency or {}
+        self.errors = errors or {}
+        self.app_rate_limit = app_rate_limit
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = dict((endpoint, 0) for endpoint in ENDPOINTS)
+        self.windows = {}
+        (self.raw_match, self.game_id, self.champions,
+         self.masteries, self.accounts) = load_fixtures()
+        for champion_id in range(1, CHAMPIONS + 1):
+            self.champions.setdefault(champion_id, "Champion{id}".format(id=champion_id))
+        self.variants = self.match_variants()
+        self.app = self.create_app()
+        self.client = self.app.test_client()
+
+    def create_app(self):
+        """Creates the Flask app with the API routes"""
+        app = Flask(__name__)
+        routes = [("summoner", "/summoner/v3/summoners/by-name/<name>", self.summoner),
+                  ("matchlist", "/match/v3/matchlists/by-account/<int:account_id>",
+                   self.matchlist),
+                  ("match", "/match/v3/matches/<int:match_id>", self.match),
+                  ("champions", "/static-data/v3/champions", self.champion_list),
+                  ("champion", "/static-data/v3/champions/<int:champion_id>", self.champion),
+                  ("mastery", "/champion-mastery/v3/champion-masteries/by-summoner/"
+                              "<int:summoner_id>/by-champion/<int:champion_id>", self.mastery)]
+        for endpoint, rule, view in routes:
+            app.add_url_rule("/<region>/lol" + rule, endpoint, self.wrap(endpoint, view))
+        return app
+
+    def wrap(self, endpoint, view):
+        """Adds latency, error injection and rate limits to a view"""
+        def wrapped(region, **kwargs):
+            """Serves a single call"""
+            with self.lock:
+                self.calls[endpoint] += 1
+                limited, headers = self.count_call(region)
+            median, sigma = self.latency.get(endpoint, (0, 0))
+            if median > 0:
+                time.sleep(self.random.lognormvariate(math.log(median), sigma) / 1000.0)
+
+            if limited:
+                headers["Retry-After"] = "1"
+                headers["X-Rate-Limit-Type"] = "application"
+                return self.error(429, "Rate limit exceeded", headers)
+
+            draw = self.random.random()
+            for status, probability in sorted(self.errors.get(endpoint, {}).items()):
+                if draw < probability:
+                    return self.error(status, "Injected error", headers)
+                draw -= probability
+
+            status, payload = view(**kwargs)
+            if status != 200:
+                return self.error(status, payload, headers)
+            return Response(response=payload, status=200, headers=headers,
+                            mimetype="application/json")
+        return wrapped
+
+    def count_call(self, region):
+        """Counts a call in the rate limit windows of the region, returns if it is
+        over a limit and the rate limit headers. The lock must be held."""
+        now = time.time()
+        limited = False
+        counts = []
+        for limit in self.app_rate_limit.split(","):
+            calls, seconds = [int(part) for part in limit.split(":")]
+            start, count = self.windows.get((region, seconds), (now, 0))
+            if now - start >= seconds:
+                start, count = now, 0
+            count += 1
+            self.windows[(region, seconds)] = (start, count)
+            limited = limited or count > calls
+            counts.append("{count}:{seconds}".format(count=count, seconds=seconds))
+        return limited, {"X-App-Rate-Limit" : self.app_rate_limit,
+                         "X-App-Rate-Limit-Count" : ",".join(counts)}
+
+    def error(self, status, message, headers):
+        """Forms an error response like the ones of the API"""
+        payload = json.dumps({"status" : {"message" : message, "status_code" : status}})
+        return Response(response=payload, status=status, headers=headers,
+                        mimetype="application/json")
+
+    def account_id(self, name):
+        """Returns the account of a summoner, made up for those not in the mock match"""
+        if name in self.accounts:
+            return self.accounts[name]
+        if name.startswith(NO_GAMES_PREFIX):
+            return 0
+        return zlib.crc32(name.encode("utf-8")) & 0x7fffffff
+
+    def summoner(self, name):
+        """Summoner by name"""
+        if name.startswith(MISSING_PREFIX):
+            return 404, "Data not found"
+        account_id = self.account_id(name)
+        return 200, json.dumps({"accountId" : account_id, "id" : account_id, "name" : name})
+
+    def matchlist(self, account_id):
+        """Matchlist of an account, with a single match"""
+        if account_id == 0:
+            return 422, "No matches found"
+        game_id = self.game_id
+        if account_id not in self.accounts.values():
+            game_id += 1 + account_id % MATCH_VARIANTS
+        return 200, json.dumps({"matches" : [{"gameId" : game_id}], "startIndex" : 0,
+                                "endIndex" : 1, "totalGames" : 1})
+
+    def match_variants(self):
+        """Builds the matches of the summoners not in the mock match, indexed by ID.
+        Each is the mock match with its ID replaced and its own participants."""
+        variants = {}
+        rnd = random.Random(0) #Same matches whatever the seed of the latency and errors
+        for match_id in range(self.game_id + 1, self.game_id + MATCH_VARIANTS + 1):
+            match = json.loads(self.raw_match.replace(str(self.game_id), str(match_id)))
+            champion_ids = rnd.sample(sorted(self.champions), len(match["participants"]))
+            for participant, champion_id in zip(match["participants"], champion_ids):
+                participant["championId"] = champion_id
+            for identity in match["participantIdentities"]:
+                summoner_id = rnd.randint(1, 10 ** 8)
+                identity["player"].update({"summonerId" : summoner_id, "accountId" : summoner_id,
+                                           "currentAccountId" : summoner_id,
+                                           "summonerName" : "player{id}".format(id=summoner_id)})
+            variants[match_id] = json.dumps(match)
+        return variants
+
+    def match(self, match_id):
+        """Match by ID, the mock match or one of its variants"""
+        if match_id == self.game_id:
+            return 200, self.raw_match
+        if match_id not in self.variants:
+            return 404, "Data not found"
+        return 200, self.variants[match_id]
+
+    def champion_list(self):
+        """All champions, indexed by ID"""
+        data = dict((str(champion_id), {"id" : champion_id, "name" : name})
+                    for champion_id, name in self.champions.items())
+        return 200, json.dumps({"type" : "champion", "data" : data})
+
+    def champion(self, champion_id):
+        """Champion by ID"""
+        if champion_id not in self.champions:
+            return 404, "Data not found"
+        return 200, json.dumps({"id" : champion_id, "name" : self.champions[champion_id]})
+
+    def mastery(self, summoner_id, champion_id):
+        """Mastery of a summoner with a champion"""
+        level = self.masteries.get(champion_id, (summoner_id + champion_id) % 7 + 1)
+        return 200, json.dumps({"championId" : champion_id, "championLevel" : level})
+
+    def total_calls(self):
+        """Returns the number of calls received"""
+        return sum(self.calls.values())
+
+    def request_get(self, url, params, stream=False, read_timeout=None):
+        """Replacement for LoL.request_get calling the fake API in process"""
+        parsed = urlparse.urlparse(url)
+        return FakeResponse(self.client.get(parsed.path, query_string=params))
+
+    def serve(self, host="127.0.0.1", port=0):
+        """Serves the fake API over HTTP in a background thread, returning the server"""
+        server = make_server(host, port, self.app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, name="fake-riot")
+        thread.daemon = True
+        thread.start()
+        return server
+
+class FakeResponse(object):
+    """Response of the fake API with the interface of a requests response."""
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = dict(response.headers)
+        self.content = response.data
+
+    def json(self):
+        """Decodes the body"""
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size):
+        """Yields the body in chunks"""
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        """Nothing to release"""
@@ -1,27 +1,52 @@
 """Methods to fetch data from the LoL API."""
+import math
+import time
 import requests
 import config
 import cache
+import matchparser
+import matchstore
+import metrics
+import ratelimit
+import refresher
+import resilience
+import sessions
+import singleflight
 
-BASE_URL = "https://{queryRegion}.api.riotgames.com/lol"
 REGIONS = {"BR" : "br1", "EUNE" : "eun1", "EUW" : "euw1", "JP" : "jp1",
            "KR" : "kr1", "LAN" : "la1", "LAS" : "la2", "NA" : "na1",
            "OCE": "oc1", "TR" : "tr1", "RU" : "ru", "PBE" : "pbe1"}
+RATE_LIMITER = ratelimit.new_rate_limiter(config.load_from_env()["SHARED_CACHE_FILE"])
+FLIGHTS = singleflight.SingleFlight()
+MATCH_CHUNK_SIZE = 16384
 
 def get_account_id(region, summoner_name):
     """Gets the account ID for a given summoner Name."""
-    #TODO add cache to method like get_champion_name
+    cache.NEGATIVES.check("account", region, summoner_name)
+    account_from_cache, stale = cache.ACCOUNTS.lookup((region, summoner_name))
+    if stale:
+        revalidate(("account", region, summoner_name), fetch_account_id, region, summoner_name)
+    if account_from_cache is not None:
+        return account_from_cache
+
+    return FLIGHTS.do(("account", region, summoner_name),
+                      fetch_account_id, region, summoner_name)
+
+def fetch_account_id(region, summoner_name):
+    """Requests the account ID for a given summoner Name and caches it."""
     summoner_url = "/summoner/v3/summoners/by-name/{summonername}"
     query = api_key_query()
     url = get_base_url(region) + summoner_url.format(summonername=summoner_name)
-    req = request_get(url, params=query)
+    req = scheduled_get(region, summoner_url, url, query)
 
     if req.status_code == 200: #All OK
-        return response_payload(req)["accountId"]
+        account_id = response_payload(req)["accountId"]
+        cache.ACCOUNTS.set((region, summoner_name), account_id)
+        return account_id
 
     if req.status_code == 404: #Summoner not found
-        raise SummonerNotFoundError("Summoner {summoner} does not exist."
-                                    .format(summoner=summoner_name))
+        raise cache.NEGATIVES.remember("account", region, summoner_name, SummonerNotFoundError(
+            "Summoner {summoner} does not exist.".format(summoner=summoner_name)))
 
     if req.status_code < 500: #Error in the request
         raise RequestError(response_payload(req)["status"]["message"])
@@ -30,16 +55,24 @@ def get_account_id(region, summoner_name):
 
 def get_latest_match(region, account_id):
     """Gets the latest match ID for a given accountID."""
+    cache.NEGATIVES.check("matchlist", region, account_id)
+    return FLIGHTS.do(("matchlist", region, account_id), fetch_latest_match, region, account_id)
+
+def fetch_latest_match(region, account_id):
+    """Requests the latest match ID for a given accountID, asking only for the newest entry."""
     matches_url = "/match/v3/matchlists/by-account/{accountid}"
     query = api_key_query()
+    query["beginIndex"] = 0
+    query["endIndex"] = 1
     url = get_base_url(region) + matches_url.format(accountid=account_id)
-    req = request_get(url, params=query)
+    req = scheduled_get(region, matches_url, url, query)
 
     if req.status_code == 200: #All OK
         return response_payload(req)["matches"][0]["gameId"]
 
     if req.status_code == 422: #No matches recorded
-        raise NoMatchesError("Summoner does not have any matches recorded.")
+        raise cache.NEGATIVES.remember("matchlist", region, account_id, NoMatchesError(
+            "Summoner does not have any matches recorded."))
 
     if req.status_code < 500: #Error in the request
         raise RequestError(response_payload(req)["status"]["message"])
@@ -48,14 +81,34 @@ def get_latest_match(region, account_id):
 
 def get_match_data(region, match_id):
     """Gets the match data based on the ID."""
-    #TODO add cache to method like get_champion_name
+    cache.NEGATIVES.check("match", region, match_id)
+    match_from_cache = cache.MATCHES.get((region, match_id))
+    if match_from_cache is not None:
+        return match_from_cache
+
+    match_from_disk = matchstore.MATCHES.get(region, match_id)
+    if match_from_disk is not None:
+        cache.MATCHES.set((region, match_id), match_from_disk)
+        return match_from_disk
+
+    return FLIGHTS.do(("match", region, match_id), fetch_match_data, region, match_id)
+
+def fetch_match_data(region, match_id):
+    """Requests the match data based on the ID and caches it in memory and on disk."""
     match_url = "/match/v3/matches/{matchid}"
     query = api_key_query()
     url = get_base_url(region) + match_url.format(matchid=match_id)
-    req = request_get(url, params=query)
+    req = scheduled_get(region, match_url, url, query, stream=True)
 
     if req.status_code == 200:
-        return response_payload(req)
+        match_data = match_payload(req)
+        cache.MATCHES.set((region, match_id), match_data)
+        matchstore.MATCHES.put(region, match_id, match_data)
+        return match_data
+
+    if req.status_code == 404: #Match not found
+        raise cache.NEGATIVES.remember("match", region, match_id, RequestError(
+            response_payload(req)["status"]["message"]))
 
     if req.status_code < 500: #Error in the request
         raise RequestError(response_payload(req)["status"]["message"])
@@ -66,12 +119,18 @@ def get_champion_name(region, champion_id):
     """Gets champion name based on ID."""
     name_from_cache = cache.get_champion_name(champion_id)
     if name_from_cache != "":
+        if cache.champion_name_stale(champion_id):
+            revalidate(("champion", region, champion_id), fetch_champion_name, region, champion_id)
         return name_from_cache
 
+    return FLIGHTS.do(("champion", region, champion_id), fetch_champion_name, region, champion_id)
+
+def fetch_champion_name(region, champion_id):
+    """Requests champion name based on ID and caches it."""
     champions_url = "/static-data/v3/champions/{id}"
     query = api_key_query()
     url = get_base_url(region) + champions_url.format(id=champion_id)
-    req = request_get(url, params=query)
+    req = scheduled_get(region, champions_url, url, query)
 
     if req.status_code == 200: #All OK
         name = response_payload(req)["name"]
@@ -83,30 +142,181 @@ def get_champion_name(region, champion_id):
 
     raise ApiError(response_payload(req)["status"]["message"]) #Server error
 
+def get_champion_list(region):
+    """Gets the names of all champions, indexed by ID."""
+    return FLIGHTS.do(("champions", region), fetch_champion_list, region)
+
+def fetch_champion_list(region):
+    """Requests the names of all champions, indexed by ID."""
+    champions_url = "/static-data/v3/champions"
+    query = api_key_query()
+    query["dataById"] = "true"
+    url = get_base_url(region) + champions_url
+    req = scheduled_get(region, champions_url, url, query)
+
+    if req.status_code == 200: #All OK
+        champions = response_payload(req)["data"]
+        return dict((champion_id, champion["name"])
+                    for champion_id, champion in champions.items())
+
+    if req.status_code < 500: #Error in the request
+        raise RequestError(response_payload(req)["status"]["message"])
+
+    raise ApiError(response_payload(req)["status"]["message"]) #Server error
+
 def get_champion_mastery(region, champion_id, summoner_id):
     """Gets the Champion Mastery for a given summoner and champion."""
+    mastery_from_cache, stale = cache.MASTERIES.lookup((region, summoner_id, champion_id))
+    if stale:
+        revalidate(("mastery", region, summoner_id, champion_id),
+                   fetch_champion_mastery, region, champion_id, summoner_id)
+    if mastery_from_cache is not None:
+        return mastery_from_cache
+
+    return FLIGHTS.do(("mastery", region, summoner_id, champion_id),
+                      fetch_champion_mastery, region, champion_id, summoner_id)
+
+def fetch_champion_mastery(region, champion_id, summoner_id):
+    """Requests the Champion Mastery for a given summoner and champion and caches it."""
     mastery_url = "/champion-mastery/v3/champion-masteries/" \
                   "by-summoner/{summonerid}/by-champion/{championid}"
     query = api_key_query()
     url = get_base_url(region) + mastery_url.format(summonerid=summoner_id, championid=champion_id)
-    req = request_get(url, params=query)
+    req = scheduled_get(region, mastery_url, url, query)
 
     if req.status_code == 200: #All OK
-        return response_payload(req)["championLevel"]
+        mastery = response_payload(req)["championLevel"]
+        cache.MASTERIES.set((region, summoner_id, champion_id), mastery)
+        return mastery
 
     if req.status_code < 500: #Error in the request
         raise RequestError(response_payload(req)["status"]["message"])
 
     raise ApiError(response_payload(req)["status"]["message"]) #Server error
 
-def request_get(url, params):
+def revalidate(key, fetch, *args):
+    """Refreshes a stale cache entry in the background, sharing the call with any
+    concurrent lookup of the same key"""
+    refresher.schedule(key, FLIGHTS.do, key, fetch, *args)
+
+def scheduled_get(region, method, url, params, stream=False):
+    """Gets request to the url once the application and method rate limits allow it.
+    A 429 blocks the limited key for 'Retry-After' seconds and the call is retried
+    while the total wait stays within RATE_LIMIT_MAX_WAIT."""
+    deadline = time.time() + config.load_from_env()["RATE_LIMIT_MAX_WAIT"]
+    keys = rate_limit_keys(region, method)
+    while True:
+        granted, wait = RATE_LIMITER.reserve(keys, deadline - time.time())
+        if not granted:
+            raise RateLimitError("Rate limit exceeded, please try again in {wait} seconds."
+                                 .format(wait=int(math.ceil(wait))), wait)
+        if wait > 0:
+            time.sleep(wait)
+
+        req = guarded_get(region, method, url, params, stream, keys)
+        headers = response_headers(req)
+        update_rate_limits(keys, headers)
+        if req.status_code != 429:
+            return req
+        if stream:
+            req.close() #Release the connection, the body won't be read
+
+        retry_after = float(headers.get("Retry-After", 1))
+        if headers.get("X-Rate-Limit-Type") == "application":
+            RATE_LIMITER.block(keys[0], retry_after)
+        else:
+            RATE_LIMITER.block(keys[1], retry_after)
+
+def guarded_get(region, method, url, params, stream, keys):
+    """Calls the API within the bulkhead and circuit breaker of the region.
+    Once the method's latency is known, calls slower than HEDGE_PERCENTILE are sent a
+    second time if the rate limits allow it without waiting, and the first reply wins."""
+    guard = resilience.get_guard(region)
+    if not guard.bulkhead.acquire(resilience.BULKHEAD_MAX_WAIT):
+        raise RegionUnavailableError("Too many pending calls to the {region} API, please try "
+                                     "again later.".format(region=region), 1)
+    try:
+        if not guard.breaker.allow():
+            wait = guard.breaker.retry_after()
+            raise RegionUnavailableError("The {region} API is unavailable, please try again in "
+                                         "{wait} seconds.".format(region=region,
+                                                                  wait=int(math.ceil(wait))),
+                                         wait)
+
+        def attempt():
+            """Calls the API once, recording the outcome and duration for the region"""
+            start = time.time()
+            success = False
+            try:
+                req = timed_request_get(region, method, url, params, stream,
+                                        guard.read_timeout(method))
+                success = req.status_code < 500
+                return req
+            finally:
+                guard.record(success, time.time() - start, method)
+
+        delay = guard.hedge_delay(method)
+        if delay is None:
+            return attempt()
+        return guard.first_of(attempt, delay, lambda: RATE_LIMITER.reserve(keys, 0)[0],
+                              lambda req: req.close())
+    finally:
+        guard.bulkhead.release()
+
+def timed_request_get(region, method, url, params, stream, read_timeout=None):
+    """Calls request_get, measuring its duration by region, method and status"""
+    metrics.UPSTREAM_IN_FLIGHT.inc(1, region)
+    start = time.time()
+    status = "error"
+    try:
+        req = request_get(url, params=params, stream=stream, read_timeout=read_timeout)
+        status = str(req.status_code)
+        return req
+    finally:
+        metrics.UPSTREAM_IN_FLIGHT.dec(1, region)
+        metrics.UPSTREAM_DURATION.observe(time.time() - start, region, method, status)
+
+def rate_limit_keys(region, method):
+    """Returns the application and method rate limit keys, applying the configured
+    limits the first time a key is used"""
+    keys = [region, (region, method)]
+    conf = config.load_from_env()
+    for key, limits in zip(keys, [conf["APP_RATE_LIMITS"], conf["METHOD_RATE_LIMITS"]]):
+        if key not in RATE_LIMITER.limits:
+            RATE_LIMITER.set_limits(key, ratelimit.parse_limits(limits))
+    return keys
+
+def update_rate_limits(keys, headers):
+    """Updates the limits with the ones reported by the API"""
+    app_limits = headers.get("X-App-Rate-Limit")
+    if app_limits:
+        RATE_LIMITER.set_limits(keys[0], ratelimit.parse_limits(app_limits))
+
+    method_limits = headers.get("X-Method-Rate-Limit")
+    if method_limits:
+        RATE_LIMITER.set_limits(keys[1], ratelimit.parse_limits(method_limits))
+
+def request_get(url, params, stream=False, read_timeout=None):
     """Gets request to the url with given params (separate for mocking purposes)"""
-    return requests.get(url, params)
+    try:
+        return sessions.get(url, params, stream, read_timeout)
+    except requests.exceptions.RequestException as ex:
+        #Only the name of the error, its message has the URL with the API key
+        raise ApiError("Could not reach the LoL API ({error})".format(error=type(ex).__name__))
 
 def response_payload(req):
     """Gets the request payload (separate for mocking purposes)"""
     return req.json()
 
+def match_payload(req):
+    """Gets the fields of the match used by the app, parsed as the body streams in
+    (separate for mocking purposes)"""
+    return matchparser.parse_match(req.iter_content(MATCH_CHUNK_SIZE))
+
+def response_headers(req):
+    """Gets the request headers (separate for mocking purposes)"""
+    return req.headers
+
 def is_valid_region(region):
     """Identifies if a given region is valid."""
     return region in REGIONS
@@ -117,7 +327,7 @@ def get_region_list():
 
 def get_base_url(region):
     """Forms the base API URL."""
-    return BASE_URL.format(queryRegion=REGIONS[region])
+    return config.load_from_env()["API_BASE_URL"].format(queryRegion=REGIONS[region])
 
 def api_key_query():
     """Forms the API Key Query."""
@@ -135,3 +345,15 @@ class ApiError(ValueError):
 
 class RequestError(ValueError):
     """Raise this when an error occurs in the request (400-499)."""
+
+class RegionUnavailableError(ValueError):
+    """Raise this when calls to a region are failed fast to protect the other regions."""
+    def __init__(self, message, retry_after):
+        ValueError.__init__(self, message)
+        self.retry_after = retry_after
+
+class RateLimitError(ValueError):
+    """Raise this when the rate limits don't allow a call within the maximum wait."""
+    def __init__(self, message, retry_after):
+        ValueError.__init__(self, message)
+        self.retry_after = retry_after
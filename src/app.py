@@ -1,32 +1,161 @@
 """The main module for the API."""
+import functools
+import hashlib
 import json
-from flask import Flask, request, current_app, Response
+import logging
+import math
+import time
+from contextlib import contextmanager
+import mimetypes
+from flask import Flask, request, current_app, Response, send_from_directory
 import LoL
+import assets
+import async_lol
+import cache
+import champions
+import config
+import metrics
+import parallel
+import watchlist
 
 APP = Flask(__name__)
+ASSETS_MAX_AGE = 31536000 #1 year
 
 @APP.route("/")
 def home():
-    """Index for front-end."""
-    return current_app.send_static_file('index.html')
+    """Index for front-end, pointing to the fingerprinted assets once they are built."""
+    if assets.built_index() is None:
+        return current_app.send_static_file('index.html')
+    resp = asset_response(assets.INDEX_NAME)
+    resp.cache_control.no_cache = True
+    return resp
+
+@APP.route("/assets/<path:filename>")
+def built_asset(filename):
+    """Endpoint that serves the built assets, cached forever as their names change
+    with their content."""
+    resp = asset_response(filename)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = ASSETS_MAX_AGE
+    resp.cache_control.immutable = True
+    return resp
 
 @APP.route("/gamedata")
 def gamedata():
     """Endpoint that returns the gamedata for a given summoner and region."""
     region = request.args.get("region", "")
     summoner = request.args.get("summoner", "")
-    payload = get_game_data(region, summoner)
+    payload, etag = get_game_response(region, summoner)
+    return conditional_response(payload, etag)
+
+@APP.route("/metrics")
+def metrics_endpoint():
+    """Endpoint that exposes the metrics in Prometheus format."""
+    return Response(response=metrics.render_all(),
+                    status=200,
+                    mimetype="text/plain; version=0.0.4")
+
+@APP.route("/gamedata/stream")
+def gamedata_stream():
+    """Endpoint that streams the gamedata as each participant gets resolved.
+    Games already resolved carry an ETag, so the browser's revalidations get a 304."""
+    region = request.args.get("region", "")
+    summoner = request.args.get("summoner", "")
+    events, etag = get_game_stream(region, summoner)
+    resp = Response(response=events,
+                    status=200,
+                    mimetype="application/x-ndjson")
+    if etag is None:
+        return resp
+    resp.set_etag(etag + "-stream") #The events differ from the /gamedata body
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+@APP.route("/gamedata/batch", methods=["POST"])
+def gamedata_batch():
+    """Endpoint that returns the gamedata for a list of summoners and regions."""
+    body = request.get_json(silent=True)
+    entries = body.get("summoners") if isinstance(body, dict) else None
+    if not isinstance(entries, list) or \
+       not all(valid_batch_entry(entry) for entry in entries):
+        raise APIError("Body must be a JSON object with a list of "
+                       "{'region', 'summoner'} objects in 'summoners'", 400)
+
+    max_size = config.load_from_env()["BATCH_MAX_SIZE"]
+    if len(entries) > max_size:
+        raise APIError("At most {max} summoners can be requested at once".format(max=max_size),
+                       400)
+
+    pairs = [(entry.get("region", ""), entry.get("summoner", "")) for entry in entries]
+    payload, encoding = compressed_payload(get_batch_data(pairs))
     resp = Response(response=payload,
                     status=200,
                     mimetype="application/json")
+    set_encoding(resp, encoding)
+    return resp
+
+def valid_batch_entry(entry):
+    """Checks if a batch entry is an object whose region and summoner are strings."""
+    return isinstance(entry, dict) and \
+           isinstance(entry.get("region", ""), basestring) and \
+           isinstance(entry.get("summoner", ""), basestring)
+
+def asset_response(name):
+    """Serves the variant of a built asset best compressed for the client."""
+    variant, encoding = assets.negotiate(name, request.accept_encodings)
+    resp = send_from_directory(assets.BUILD_DIR, variant,
+                               mimetype=mimetypes.guess_type(name)[0] or "application/octet-stream")
+    set_encoding(resp, encoding)
+    return resp
+
+def conditional_response(payload, etag):
+    """Generates a JSON response which is a 304 if the client has the same ETag.
+    Compressed responses get their own ETag, as their body differs, and the body is
+    only compressed once the response is known not to be a 304."""
+    payload = payload_bytes(payload)
+    encoding = payload_encoding(payload)
+    resp = Response(status=200, mimetype="application/json")
+    set_encoding(resp, encoding)
+    resp.set_etag(etag if encoding is None else etag + "-" + encoding)
+    resp.cache_control.no_cache = True
+    resp.make_conditional(request)
+    if resp.status_code == 200:
+        resp.set_data(assets.encode(payload, encoding))
     return resp
 
+def compressed_payload(payload):
+    """Compresses a response body with the encoding from payload_encoding.
+    Returns the (body, content encoding)."""
+    payload = payload_bytes(payload)
+    encoding = payload_encoding(payload)
+    return assets.encode(payload, encoding), encoding
+
+def payload_bytes(payload):
+    """Encodes a response body to UTF-8 if needed."""
+    if isinstance(payload, unicode): #Responses read back from the shared cache
+        return payload.encode("utf-8")
+    return payload
+
+def payload_encoding(payload):
+    """Gets the best encoding accepted by the client for a response body of at least
+    COMPRESS_MIN_SIZE bytes, or None if it is sent as it is."""
+    if len(payload) < config.load_from_env()["COMPRESS_MIN_SIZE"]:
+        return None
+    return assets.preferred_encoding(request.accept_encodings)
+
+def set_encoding(resp, encoding):
+    """Sets the content encoding of a response, which depends on 'Accept-Encoding'."""
+    resp.vary.add("Accept-Encoding")
+    if encoding is not None:
+        resp.headers["Content-Encoding"] = encoding
+
 class APIError(Exception):
     """Custom exception handling API errors."""
-    def __init__(self, message, status_code):
+    def __init__(self, message, status_code, retry_after=None):
         Exception.__init__(self)
         if status_code is not None:
             self.status_code = status_code
+        self.retry_after = retry_after
         self.message = error_response(message, status_code)
 
 @APP.errorhandler(APIError)
@@ -35,12 +164,158 @@ def handle_api_error(error):
     resp = Response(response=error.message,
                     status=error.status_code,
                     mimetype="application/json")
+    if error.retry_after is not None:
+        resp.headers["Retry-After"] = str(int(math.ceil(error.retry_after)))
     return resp
 
+def instrumented(handler):
+    """Measures the duration, status and concurrency of a game data function,
+    tracing the time of its phases when TRACE_REQUESTS is set."""
+    def decorator(func):
+        """Wraps the function"""
+        @functools.wraps(func)
+        def wrapper(region, summoner):
+            """Calls the function, measuring it"""
+            tracing = config.load_from_env()["TRACE_REQUESTS"]
+            if tracing:
+                metrics.start_trace()
+            metrics.REQUESTS_IN_FLIGHT.inc(1, handler)
+            start = time.time()
+            status = 200
+            try:
+                return func(region, summoner)
+            except APIError as error:
+                status = error.status_code
+                raise
+            finally:
+                metrics.REQUESTS_IN_FLIGHT.dec(1, handler)
+                metrics.REQUEST_DURATION.observe(time.time() - start, handler, str(status))
+                if tracing:
+                    metrics.finish_trace(u"{handler} region={region} summoner={summoner} "
+                                         u"status={status}".format(handler=handler,
+                                                                   region=region,
+                                                                   summoner=summoner,
+                                                                   status=status))
+        return wrapper
+    return decorator
+
 def get_game_data(region, summoner):
     """Gets the game data."""
+    return get_game_response(region, summoner)[0]
+
+@instrumented("gamedata")
+def get_game_response(region, summoner):
+    """Gets the serialized game data and its ETag, cached per latest game."""
+    validate_parameters(region, summoner)
+
+    with api_errors():
+        with metrics.phase("account"):
+            account_id = LoL.get_account_id(region, summoner)
+        with metrics.phase("matchlist"):
+            latest_match = LoL.get_latest_match(region, account_id)
+        return game_response(region, summoner, latest_match)
+
+def game_response(region, summoner, game_id):
+    """Gets the serialized data and ETag of a game, cached per summoner and game.
+    Also called by the watchlist to prewarm the games of watched summoners."""
+    response_key = (region, summoner, game_id)
+    response_from_cache = cache.RESPONSES.get(response_key)
+    if response_from_cache is not None:
+        return response_from_cache
+
+    with metrics.phase("match"):
+        match_data = LoL.get_match_data(region, game_id)
+    with metrics.phase("participants"):
+        game_data = parse_match_data(region, match_data)
+    with metrics.phase("serialize"):
+        return cache_response(response_key, json.dumps(game_data))
+
+def get_batch_data(pairs):
+    """Gets the serialized game data of several (region, summoner) pairs at once.
+    Repeated pairs are only resolved once, and all of them run concurrently, so
+    accounts, matches, champions and masteries they share are fetched only once."""
+    futures = {}
+    for pair in pairs:
+        if pair not in futures:
+            futures[pair] = async_lol.submit(pair[0], get_batch_entry, *pair)
+
+    deadline = time.time() + config.load_from_env()["BATCH_TIMEOUT"]
+    results = []
+    for region, summoner in pairs:
+        try:
+            status, body = futures[(region, summoner)].result(max(deadline - time.time(), 0))
+        except parallel.LookupTimeoutError as timeout_error:
+            status, body = 504, error_response(timeout_error.message, 504)
+        key = "data" if status == 200 else "error"
+        results.append('{{"region": {region}, "summoner": {summoner}, '
+                       '"status": {status}, "{key}": {body}}}'
+                       .format(region=json.dumps(region), summoner=json.dumps(summoner),
+                               status=status, key=key, body=body))
 
-    #Handle invalid parameters
+    return '{"results": [' + ", ".join(results) + ']}'
+
+def get_batch_entry(region, summoner):
+    """Gets the status and serialized game data (or error) of a single batch entry."""
+    try:
+        return 200, get_game_data(region, summoner)
+    except APIError as error:
+        return error.status_code, error.message
+
+def get_game_stream(region, summoner):
+    """Gets the game data as NDJSON events: a 'header' with the game ID, a 'participant'
+    event as soon as each participant is resolved, and a 'complete' event with the
+    sorted game data. Errors before the header are raised, later ones are sent as an
+    'error' event. Returns the (events, ETag), the ETag being None unless the game was
+    already resolved."""
+    validate_parameters(region, summoner)
+
+    with api_errors():
+        account_id = LoL.get_account_id(region, summoner)
+        latest_match = LoL.get_latest_match(region, account_id)
+        response_key = (region, summoner, latest_match)
+        response_from_cache = cache.RESPONSES.get(response_key)
+        if response_from_cache is not None:
+            return stream_cached_game(response_from_cache[0]), response_from_cache[1]
+
+        match_data = LoL.get_match_data(region, latest_match)
+        return stream_game(region, response_key, match_data["gameId"],
+                           participant_rows(match_data)), None
+
+def stream_game(region, response_key, game_id, participant_list):
+    """Streams the participants of a game as their lookups finish."""
+    yield json.dumps({"type" : "header", "gameId" : game_id}) + "\n"
+
+    timeout = config.load_from_env()["LOOKUP_TIMEOUT"]
+    futures = [async_lol.submit(region, complete_participant, region, participant)
+               for participant in participant_list]
+    try:
+        with api_errors():
+            for future in async_lol.as_completed(futures, timeout):
+                yield json.dumps({"type" : "participant", "participant" : future.value}) + "\n"
+    except APIError as error:
+        yield '{"type": "error", "error": ' + error.message + '}\n'
+        return
+
+    payload = cache_response(response_key,
+                             json.dumps(match_result(game_id, participant_list)))[0]
+    yield '{"type": "complete", "data": ' + payload + '}\n'
+
+def stream_cached_game(payload):
+    """Streams the events of an already resolved game all at once."""
+    game = json.loads(payload)
+    yield json.dumps({"type" : "header", "gameId" : game["gameId"]}) + "\n"
+    for participant in game["participants"]:
+        yield json.dumps({"type" : "participant", "participant" : participant}) + "\n"
+    yield '{"type": "complete", "data": ' + payload + '}\n'
+
+def cache_response(response_key, payload):
+    """Caches a serialized response along with its ETag."""
+    response = (payload, hashlib.sha1(payload).hexdigest())
+    cache.RESPONSES.set(response_key, response)
+    return response
+
+def validate_parameters(region, summoner):
+    """Validates the region and summoner parameters."""
     if region == "":
         raise APIError("Region parameter is mandatory", 400)
 
@@ -52,11 +327,14 @@ def get_game_data(region, summoner):
                   "Please select one from the following list: {list}"
         raise APIError(message.format(inRegion=region, list=LoL.get_region_list()), 404)
 
+@contextmanager
+def api_errors():
+    """Translates the errors raised while fetching data into API errors."""
     try:
-        account_id = LoL.get_account_id(region, summoner)
-        latest_match = LoL.get_latest_match(region, account_id)
-        match_data = LoL.get_match_data(region, latest_match)
-        return json.dumps(parse_match_data(region, match_data))
+        yield
+
+    except APIError:
+        raise
 
     #Handle API Errors
     except LoL.SummonerNotFoundError as summ_error:
@@ -65,42 +343,71 @@ def get_game_data(region, summoner):
     except LoL.NoMatchesError as matches_error:
         raise APIError(matches_error.message, 404)
 
+    except LoL.RateLimitError as rate_error:
+        raise APIError(rate_error.message, 429, rate_error.retry_after)
+
+    except LoL.RegionUnavailableError as region_error:
+        raise APIError(region_error.message, 503, region_error.retry_after)
+
     except LoL.ApiError as api_error:
         raise APIError(api_error.message, 500)
 
     except LoL.RequestError as request_error:
         raise APIError(request_error.message, 500)
 
+    except parallel.LookupTimeoutError as timeout_error:
+        raise APIError(timeout_error.message, 504)
+
     except Exception as ex:
         raise APIError(ex.message, 500)
 
 def parse_match_data(region, match_info):
     """Gets match data from response JSON object"""
+    timeout = config.load_from_env()["LOOKUP_TIMEOUT"]
+    participant_list = parallel.map_ordered(lambda part: complete_participant(region, part),
+                                            participant_rows(match_info), timeout, region)
+    return match_result(match_info["gameId"], participant_list)
+
+def complete_participant(region, participant):
+    """Resolves champion name and mastery for a single participant"""
+    champion_id = participant["championId"]
+    participant["championName"] = LoL.get_champion_name(region, champion_id)
+    participant["championMastery"] = LoL.get_champion_mastery(region, champion_id,
+                                                              participant["summonerId"])
+    return participant
+
+def participant_rows(match_info):
+    """Joins the identity and data of each participant, before any lookup"""
     participant_list = []
+    participants_data = dict((p["participantId"], p) for p in match_info["participants"])
 
     for player in match_info["participantIdentities"]:
-        p_id = player["participantId"]
-        summoner_name = player["player"]["summonerName"]
-        summoner_id = player["player"]["summonerId"]
-        p_data = [p for p in match_info["participants"] if p["participantId"] == p_id][0]
-        team_id = p_data["teamId"]
-        champion_id = p_data["championId"]
-        champion_name = LoL.get_champion_name(region, champion_id)
-        champion_mastery = LoL.get_champion_mastery(region, champion_id, summoner_id)
-        participant = {"summonerId" : summoner_id, "summonerName" : summoner_name,
-                       "teamId" : team_id, "championId" : champion_id,
-                       "championName" : champion_name, "championMastery" : champion_mastery}
+        p_data = participants_data[player["participantId"]]
+        participant = {"summonerId" : player["player"]["summonerId"],
+                       "summonerName" : player["player"]["summonerName"],
+                       "teamId" : p_data["teamId"], "championId" : p_data["championId"]}
         participant_list.append(participant)
 
-    return {"gameId" : match_info["gameId"],
+    return participant_list
+
+def match_result(game_id, participant_list):
+    """Forms the game data, with participants sorted by mastery and champion"""
+    return {"gameId" : game_id,
             "participants" : sorted(participant_list,
                                     key=lambda part: (part["championMastery"], part["championId"]))}
 
-
 def error_response(message, status_code):
     """Generates a generic error response."""
     return json.dumps({"status" : {"message" : message, "status_code" : status_code}})
 
+def start_background_tasks():
+    """Starts the tasks keeping the caches warm and sharing the metrics."""
+    metrics.start_publisher(config.load_from_env()["SHARED_CACHE_FILE"])
+    champions.start_refresher()
+    watchlist.start_watcher(game_response)
+
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    start_background_tasks()
     APP.run(host="0.0.0.0", port=80)
     
\ No newline at end of file
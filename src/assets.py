@@ -0,0 +1,133 @@
+"""Builds the static assets for production and serves them.
+Every file in static is copied to static/build with a hash of its content in the name,
+along with gzip (and, if the brotli module is installed, brotli) variants of the text
+files, so they can be cached forever by browsers. index.html is rewritten to point to
+the fingerprinted files.
+
+Run at build time: python src/assets.py"""
+import hashlib
+import json
+import os
+import shutil
+import zlib
+try:
+    import brotli
+except ImportError: #Optional, only gzip variants are built without it
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+BUILD_DIR = os.path.join(STATIC_DIR, "build")
+MANIFEST_NAME = "manifest.json"
+INDEX_NAME = "index.html"
+COMPRESSIBLE = (".html", ".js", ".css", ".json", ".svg", ".ico")
+MIN_SAVING = 0.1 #Compressed variants must be at least 10% smaller to be kept
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")] #In order of preference
+
+def fingerprinted(name, content):
+    """Returns the name of a file with a hash of its content before the extension"""
+    base, extension = os.path.splitext(name)
+    if base.endswith(".min"): #Keeps 'jquery.min.js' recognizable as minified
+        base, extension = base[:-4], ".min" + extension
+    return "{base}.{digest}{extension}".format(base=base, extension=extension,
+                                               digest=hashlib.sha1(content).hexdigest()[:12])
+
+def gzip_compress(content):
+    """Compresses in gzip format, with no timestamp so builds are reproducible"""
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(content) + compressor.flush()
+
+def compressed_variants(content):
+    """Returns the (suffix, content) of the compressed variants worth keeping"""
+    variants = [(".gz", gzip_compress(content))]
+    if brotli is not None:
+        variants.append((".br", brotli.compress(content)))
+    return [(suffix, data) for suffix, data in variants
+            if len(data) <= len(content) * (1 - MIN_SAVING)]
+
+def write(path, content):
+    """Writes a file, creating its directory"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, "wb") as output:
+        output.write(content)
+
+def write_asset(target, name, content):
+    """Writes a file and its compressed variants"""
+    write(os.path.join(target, name), content)
+    if name.endswith(COMPRESSIBLE):
+        for suffix, data in compressed_variants(content):
+            write(os.path.join(target, name + suffix), data)
+
+def build(source=STATIC_DIR, target=BUILD_DIR):
+    """Builds the fingerprinted and compressed assets, returning the manifest
+    which maps each original path to its fingerprinted one"""
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+
+    manifest = {}
+    for directory, subdirectories, names in os.walk(source):
+        if os.path.abspath(directory) == os.path.abspath(source) and \
+           os.path.basename(target) in subdirectories:
+            subdirectories.remove(os.path.basename(target))
+        for name in names:
+            path = os.path.relpath(os.path.join(directory, name), source).replace(os.sep, "/")
+            if path == INDEX_NAME:
+                continue
+            with open(os.path.join(directory, name), "rb") as asset:
+                content = asset.read()
+            manifest[path] = fingerprinted(path, content)
+            write_asset(target, manifest[path], content)
+
+    with open(os.path.join(source, INDEX_NAME), "rb") as index:
+        write_asset(target, INDEX_NAME, rewrite_index(index.read(), manifest))
+    write(os.path.join(target, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True))
+    return manifest
+
+def rewrite_index(html, manifest):
+    """Points the references of index.html to the fingerprinted assets, and gives the
+    scripts the manifest to find the files they reference"""
+    for path in sorted(manifest, key=len, reverse=True):
+        html = html.replace('"static/' + path + '"', '"assets/' + manifest[path] + '"')
+    urls = dict((path, "assets/" + fingerprinted_path)
+                for path, fingerprinted_path in manifest.items())
+    script = "<script>var ASSETS = {assets};</script>\n    ".format(
+        assets=json.dumps(urls, sort_keys=True))
+    return html.replace("<script", script + "<script", 1)
+
+def built_index():
+    """Returns the path of the built index.html, or None if the assets weren't built"""
+    path = os.path.join(BUILD_DIR, INDEX_NAME)
+    return path if os.path.isfile(path) else None
+
+def negotiate(name, accept_encodings):
+    """Returns the (file name, content encoding) of the best variant of a built asset
+    accepted by the client, given its parsed 'Accept-Encoding'"""
+    for encoding, suffix in ENCODINGS:
+        if accept_encodings.quality(encoding) > 0 and \
+           os.path.isfile(os.path.join(BUILD_DIR, name + suffix)):
+            return name + suffix, encoding
+    return name, None
+
+def preferred_encoding(accept_encodings):
+    """Returns the best content encoding accepted by the client for a response body,
+    or None if it should be sent as it is"""
+    if brotli is not None and accept_encodings.quality("br") > 0:
+        return "br"
+    if accept_encodings.quality("gzip") > 0:
+        return "gzip"
+    return None
+
+def encode(payload, encoding):
+    """Compresses a response body with a content encoding from preferred_encoding."""
+    if encoding == "br":
+        return brotli.compress(payload, quality=5) #Fast enough per request
+    if encoding == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(payload) + compressor.flush()
+    return payload
+
+if __name__ == "__main__":
+    print "Built {count} assets in {target}{brotli}".format(
+        count=len(build()), target=BUILD_DIR,
+        brotli="" if brotli is not None else " (without brotli variants)")
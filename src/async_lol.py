@@ -0,0 +1,89 @@
+"""Runs calls to the LoL client in the background.
+Each call returns a Future right away and runs on a pool of IO threads shared by the
+regions, so a request can start all its independent calls before waiting for any of them."""
+import Queue
+import threading
+import time
+import config
+import parallel
+
+POOL = None
+POOL_LOCK = threading.Lock()
+
+class Future(object):
+    """Result of a call running in the background."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def set_outcome(self, value, error):
+        """Stores the outcome of the call and notifies the listeners"""
+        with self.lock:
+            self.value = value
+            self.error = error
+            self.done.set()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener(self)
+
+    def add_listener(self, listener):
+        """Calls listener(future) once the call finishes (right away if it already did)"""
+        with self.lock:
+            if not self.done.is_set():
+                self.listeners.append(listener)
+                return
+        listener(self)
+
+    def result(self, timeout):
+        """Waits for the call and returns its value, or raises its exception"""
+        if not self.done.wait(timeout):
+            raise parallel.LookupTimeoutError("Lookup did not finish within {timeout} seconds."
+                                              .format(timeout=timeout))
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+def get_pool():
+    """Returns the IO pool, creating it on first use"""
+    global POOL
+    with POOL_LOCK:
+        if POOL is None:
+            conf = config.load_from_env()
+            POOL = parallel.RegionPool(conf["ASYNC_POOL_SIZE"], conf["ASYNC_REGION_CONCURRENCY"])
+        return POOL
+
+def submit(region, func, *args):
+    """Runs func(*args) on the IO pool within the slots of the region, returning its Future"""
+    future = Future()
+
+    def run():
+        """Runs the call, storing its outcome in the future"""
+        try:
+            future.set_outcome(func(*args), None)
+        except Exception as ex:
+            future.set_outcome(None, ex)
+
+    get_pool().apply_async(region, run)
+    return future
+
+def as_completed(futures, timeout):
+    """Yields the futures as their calls finish.
+    Raises the first exception raised by any call without waiting for the others."""
+    finished = Queue.Queue()
+    for future in futures:
+        future.add_listener(finished.put)
+
+    deadline = time.time() + timeout
+    for _ in futures:
+        try:
+            future = finished.get(timeout=max(deadline - time.time(), 0))
+        except Queue.Empty:
+            raise parallel.LookupTimeoutError("Lookups did not finish within {timeout} seconds."
+                                              .format(timeout=timeout))
+        if future.error is not None:
+            raise future.error
+        yield future
@@ -3,32 +3,429 @@ import time
 import threading
 import json
 import os
+import sys
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError: #Windows
+    fcntl = None
+import config
+import metrics
+import sharedcache
 
 
 CHAMPIONS_CACHE_TIME = 604800L #Cache champions names for 1 week max
 CHAMPIONS_LOCK = threading.Lock()
+ACCOUNTS_CACHE_TIME = 86400 #Summoners rarely change account, cache for 1 day
+MASTERIES_CACHE_TIME = 600 #Mastery levels go up while playing, cache for 10 minutes
+NEGATIVE_CACHE_TIMES = {"account" : 300, #Missing summoners, names are rarely claimed
+                        "matchlist" : 60, #Summoners without matches, until their first game
+                        "match" : 600} #Unknown match IDs
+NEGATIVE_CACHE_MAX_ENTRIES = 5000 #Per region and kind of lookup
+GENERATION_CHECK_INTERVAL = 1 #Seconds between checks for invalidations by other workers
+CHAMPIONS_CHECK_INTERVAL = 1 #Seconds between checks for champions added by other workers
+EXPIRY_JITTER = 0.1 #Expire entries up to 10% early so entries stored together don't expire together
+CACHE_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                          os.pardir, "cache"))
 
-def champions_file_path():
-    """Finds the path for the cache"""
-    if os.getenv("CONTAINER"):
-        return "/app/cache/champions.json"
-    else:
-        return os.path.dirname(os.path.abspath(__file__)) + "\\..\\cache\\champions.json"
+class AppendOnlyStore(object):
+    """Stores records as JSON lines appended to a file, shared by every worker process.
+    Each append is a single write on a file opened in append mode, so a crash can
+    only lose the line being written, which is skipped when loading. The latest
+    record of each key wins. Records appended by other processes are picked up by
+    reading the file from where the last read stopped, and the file is compacted
+    in the background, by one process at a time, once it holds too many superseded
+    records."""
 
-CHAMPIONS_FILE = champions_file_path()
+    def __init__(self, path, compact_ratio=2, compact_min=100):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.append_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.fd = None
+        self.identity = None
+        self.offset = 0
+        self.lines = 0
+        self.compacting = False
+
+    def load(self):
+        """Reads every record from the file, skipping corrupt lines"""
+        with self.read_lock:
+            self.identity = None
+            return self.read_new()
+
+    def refresh(self):
+        """Reads the records appended since the last read"""
+        with self.read_lock:
+            return self.read_new()
+
+    def read_new(self):
+        """Reads the complete lines after the last read, or the whole file if it was
+        replaced by a compaction. The read lock must be held."""
+        try:
+            with open(self.path, "rb") as store:
+                stat = os.fstat(store.fileno())
+                identity = (stat.st_dev, stat.st_ino)
+                if identity != self.identity or stat.st_size < self.offset:
+                    self.identity, self.offset, self.lines = identity, 0, 0
+                store.seek(self.offset)
+                data = store.read()
+        except (IOError, OSError):
+            return {}
+
+        end = data.rfind("\n") + 1
+        self.offset += end
+        return parse_records(data[:end], self)
+
+    def append(self, records):
+        """Appends records to the end of the file"""
+        data = "".join(json.dumps(record) + "\n" for record in records)
+        with self.append_lock:
+            with file_lock(self.lock_path, exclusive=False):
+                self.open_current()
+                os.write(self.fd, data)
+
+    def open_current(self):
+        """Opens the file for appending, again if a compaction replaced it.
+        Starts with a new line if the last write was cut short by a crash."""
+        if self.fd is not None:
+            try:
+                stat = os.stat(self.path)
+                current = os.fstat(self.fd)
+                if (stat.st_dev, stat.st_ino) == (current.st_dev, current.st_ino):
+                    return
+            except OSError:
+                pass
+            os.close(self.fd)
+
+        self.fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0644)
+        size = os.fstat(self.fd).st_size
+        if size > 0:
+            os.lseek(self.fd, size - 1, os.SEEK_SET)
+            if os.read(self.fd, 1) != "\n":
+                os.write(self.fd, "\n")
+
+    def needs_compaction(self, live_records):
+        """Checks if the file holds too many superseded records"""
+        return not self.compacting and \
+               self.lines > max(self.compact_min, self.compact_ratio * live_records)
+
+    def compact(self):
+        """Rewrites the file keeping only the latest record of each key.
+        Appends from every process wait until the new file is in place, and nothing
+        is done if another process is already compacting."""
+        with self.append_lock:
+            with file_lock(self.lock_path, exclusive=True, blocking=False) as acquired:
+                if not acquired:
+                    return False
+
+                try:
+                    with open(self.path, "rb") as store:
+                        records = parse_records(store.read())
+                except IOError:
+                    return False
+
+                temp_path = self.path + ".tmp"
+                with open(temp_path, "wb") as temp:
+                    for record in records.values():
+                        temp.write(json.dumps(record) + "\n")
+                    temp.flush()
+                    os.fsync(temp.fileno())
+                if os.name == "nt" and os.path.exists(self.path):
+                    os.remove(self.path) #os.rename doesn't overwrite on Windows
+                os.rename(temp_path, self.path)
+                return True
+
+    def compact_in_background(self):
+        """Compacts the file in a separate thread"""
+        if self.compacting:
+            return None
+        self.compacting = True
+
+        def run():
+            """Compacts and then allows further compactions"""
+            try:
+                self.compact()
+            finally:
+                self.compacting = False
+
+        thread = threading.Thread(target=run, name="cache-compaction")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+def parse_records(data, store=None):
+    """Parses JSON lines into records by ID, counting the lines read in the store"""
+    records = {}
+    for line in data.splitlines():
+        if store is not None:
+            store.lines += 1
+        try:
+            record = json.loads(line)
+            records[record["id"]] = record
+        except (ValueError, KeyError, TypeError):
+            continue
+    return records
+
+@contextmanager
+def file_lock(path, exclusive, blocking=True):
+    """Locks a file between processes, yielding whether the lock was acquired.
+    Without fcntl (on Windows) it only works for a single process."""
+    if fcntl is None:
+        yield True
+        return
+
+    with open(path, "a") as lock_file:
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lock_file.fileno(), flags)
+        except IOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+class TTLCache(object):
+    """Keeps values in memory for ttl seconds (forever if None), evicting the least
+    recently used ones when there are more than max_entries or, if given, when their
+    approximate size goes over max_bytes.
+    Expired values are still returned, flagged as stale, for stale_ttl seconds so that
+    they can be served while being refreshed.
+    With a shared cache, misses are looked up in it and values are written through to
+    it, so worker processes share their entries. Invalidations by another process are
+    noticed within GENERATION_CHECK_INTERVAL seconds."""
+
+    def __init__(self, ttl, max_entries, max_bytes=None, shared=None, stale_ttl=0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.stale_ttl = stale_ttl
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.generation = shared.generation() if shared is not None else None
+        self.generation_checked = time.time()
+
+    def get(self, key):
+        """Returns the value for a key, or None if it is missing or expired"""
+        return self.lookup(key)[0]
+
+    def lookup(self, key):
+        """Returns the value for a key and whether it is stale, or (None, False) if it is
+        missing or expired for longer than stale_ttl"""
+        self.check_generation()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires, size = entry
+                if expires is None or expires + self.stale_ttl >= time.time():
+                    del self.entries[key]
+                    self.entries[key] = entry
+                    return value, self.count_hit(expires)
+                self.remove(key)
+
+            if self.shared is None:
+                self.misses += 1
+                return None, False
+
+        shared_entry = self.shared.get_entry(key)
+        with self.lock:
+            if shared_entry is None:
+                self.misses += 1
+                return None, False
+            self.shared_hits += 1
+            self.store(key, shared_entry[0], shared_entry[1])
+            return shared_entry[0], self.count_hit(shared_entry[1])
+
+    def count_hit(self, expires):
+        """Counts a hit on a value expiring at the given time, returning if it is stale"""
+        self.hits += 1
+        stale = expires is not None and expires < time.time()
+        if stale:
+            self.stale_hits += 1
+        return stale
+
+    def set(self, key, value):
+        """Stores a value, evicting the least recently used ones if over the bounds"""
+        ttl = jittered(self.ttl, key)
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock:
+            self.store(key, value, expires)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def store(self, key, value, expires):
+        """Stores a value in memory, the lock must be held"""
+        size = approximate_size(value) if self.max_bytes is not None else 0
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (value, expires, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or \
+              (self.max_bytes is not None and self.size > self.max_bytes and
+               len(self.entries) > 1):
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key):
+        """Removes a key, the lock must be held"""
+        self.size -= self.entries.pop(key)[2]
+
+    def invalidate(self, key):
+        """Removes a key, also from the other processes"""
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+        if self.shared is not None:
+            self.shared.invalidate(key)
+            self.generation = self.shared.generation()
+
+    def clear(self):
+        """Removes every entry, also from the other processes"""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        if self.shared is not None:
+            self.shared.invalidate()
+            self.generation = self.shared.generation()
+
+    def check_generation(self):
+        """Drops the entries in memory if another process invalidated the shared cache"""
+        if self.shared is None or \
+           time.time() - self.generation_checked < GENERATION_CHECK_INTERVAL:
+            return
+        self.generation_checked = time.time()
+        generation = self.shared.generation()
+        if generation != self.generation:
+            with self.lock:
+                self.entries.clear()
+                self.size = 0
+            self.generation = generation
+
+    def stats(self):
+        """Returns the usage counters"""
+        return {"entries" : len(self.entries), "bytes" : self.size, "hits" : self.hits,
+                "shared_hits" : self.shared_hits, "stale_hits" : self.stale_hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions}
+
+class NegativeCache(object):
+    """Remembers the lookups which failed with an error that repeating them would
+    reproduce, for a short ttl per kind of lookup. Each region has its own bounded
+    caches, so a storm of bad lookups in one region doesn't evict the others."""
+
+    def __init__(self, ttls, max_entries):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.caches = {}
+
+    def cache_for(self, kind, region):
+        """Returns the cache of a kind of lookup in a region, creating it on first use"""
+        with self.lock:
+            if (kind, region) not in self.caches:
+                self.caches[(kind, region)] = TTLCache(self.ttls[kind], self.max_entries)
+            return self.caches[(kind, region)]
+
+    def check(self, kind, region, key):
+        """Raises the error remembered for a lookup again, if any"""
+        error = self.cache_for(kind, region).get(key)
+        if error is not None:
+            raise error[0](error[1])
+
+    def remember(self, kind, region, key, error):
+        """Remembers the error of a lookup, returning it to be raised"""
+        self.cache_for(kind, region).set(key, (type(error), error.message))
+        return error
+
+    def clear(self):
+        """Forgets every error"""
+        with self.lock:
+            self.caches.clear()
+
+    def stats(self):
+        """Returns the usage counters summed over every region"""
+        with self.lock:
+            caches = self.caches.values()
+        totals = {"entries" : 0, "hits" : 0, "misses" : 0, "evictions" : 0}
+        for negative_cache in caches:
+            stats = negative_cache.stats()
+            for name in totals:
+                totals[name] += stats[name]
+        return totals
+
+def jittered(ttl, key):
+    """Shortens a ttl by up to EXPIRY_JITTER, always by the same amount for a key"""
+    if ttl is None:
+        return None
+    return ttl * (1 - EXPIRY_JITTER * (zlib.crc32(repr(key)) % 1000) / 1000.0)
+
+def approximate_size(value):
+    """Approximates the memory used by a value decoded from JSON"""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.iteritems():
+            size += approximate_size(key) + approximate_size(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += approximate_size(item)
+    return size
+
+def shared_cache(table, max_entries, grace=0):
+    """Returns the cache shared between workers for a table, if SHARED_CACHE_FILE is set"""
+    path = config.load_from_env()["SHARED_CACHE_FILE"]
+    if not path:
+        return None
+    return sharedcache.SharedCache(path, table, max_entries, grace)
+
+ACCOUNTS = TTLCache(ACCOUNTS_CACHE_TIME, 10000, #Served stale for 1 more day while refreshed
+                    shared=shared_cache("accounts", 100000, ACCOUNTS_CACHE_TIME),
+                    stale_ttl=ACCOUNTS_CACHE_TIME)
+MATCHES = TTLCache(None, 1000, 64 * 1024 * 1024) #Finished matches never change, on disk
+MASTERIES = TTLCache(MASTERIES_CACHE_TIME, 50000, #Served stale for 10 more minutes
+                     shared=shared_cache("masteries", 500000, MASTERIES_CACHE_TIME),
+                     stale_ttl=MASTERIES_CACHE_TIME)
+RESPONSES = TTLCache(MASTERIES_CACHE_TIME, 5000, 32 * 1024 * 1024, #Includes masteries
+                     shared=shared_cache("responses", 50000))
+
+NEGATIVES = NegativeCache(NEGATIVE_CACHE_TIMES, NEGATIVE_CACHE_MAX_ENTRIES)
+
+TTL_CACHES = {"accounts" : ACCOUNTS, "matches" : MATCHES, "masteries" : MASTERIES,
+              "responses" : RESPONSES}
+
+CHAMPIONS_FILE = os.path.join(CACHE_DIR, "champions.jsonl")
+CHAMPIONS_STORE = AppendOnlyStore(CHAMPIONS_FILE)
 
 def load_from_file():
     """Loads the stored champions from file"""
-    try:
-        with open(CHAMPIONS_FILE, "r") as myfile:
-            data = myfile.read()
-            return json.loads(data)
-    except IOError:
-        return {}
-    except ValueError:
-        return {}
+    return champions_from_records(CHAMPIONS_STORE.load())
+
+def champions_from_records(records):
+    """Converts store records into cached champions"""
+    return dict((str(record["id"]), {"name" : record["name"], "time" : record["time"]})
+                for record in records.values())
+
+def refresh_champions():
+    """Adds the champions appended to the store since the last read, e.g. by other workers"""
+    CHAMPIONS_STATS["checked"] = time.time()
+    CHAMPIONS.update(champions_from_records(CHAMPIONS_STORE.refresh()))
 
 CHAMPIONS = load_from_file()
+CHAMPIONS_STATS = {"hits" : 0, "stale_hits" : 0, "misses" : 0, "checked" : time.time()}
 
 def champion_name_available(champion_id):
     """Checks if a champion is available in cache and fresh"""
@@ -36,26 +433,80 @@ def champion_name_available(champion_id):
         return False
 
     storetime = CHAMPIONS[str(champion_id)]["time"]
-    if storetime + CHAMPIONS_CACHE_TIME < curr_time_long():
+    if storetime + jittered(CHAMPIONS_CACHE_TIME, str(champion_id)) < curr_time_long():
         return False
 
     return True
 
+def champion_name_stale(champion_id):
+    """Checks if a champion is in cache but should be refreshed"""
+    return str(champion_id) in CHAMPIONS and not champion_name_available(champion_id)
+
 def get_champion_name(champion_id):
-    """Returns the champion name from cache"""
-    if not champion_name_available(champion_id):
+    """Returns the champion name from cache, even if stale (names almost never change)"""
+    if time.time() - CHAMPIONS_STATS["checked"] > CHAMPIONS_CHECK_INTERVAL:
+        refresh_champions()
+
+    if str(champion_id) not in CHAMPIONS:
+        CHAMPIONS_STATS["misses"] += 1
         return ""
 
+    CHAMPIONS_STATS["hits"] += 1
+    if not champion_name_available(champion_id):
+        CHAMPIONS_STATS["stale_hits"] += 1
     return CHAMPIONS[str(champion_id)]["name"]
 
 def add_champion_name(champion_id, champion_name):
     """Adds a new champion to the cache"""
+    add_champion_names({champion_id : champion_name})
+
+def add_champion_names(champion_names):
+    """Adds or refreshes several champions in the cache with a single append"""
+    now = curr_time_long()
+    records = [{"id" : str(champion_id), "name" : champion_name, "time" : now}
+               for champion_id, champion_name in champion_names.items()]
     with CHAMPIONS_LOCK:
-        if champion_name_available(champion_id):
-            CHAMPIONS[str(champion_id)]["time"] = curr_time_long()
-        else:
-            CHAMPIONS[str(champion_id)] = {"name" : champion_name, "time" : curr_time_long()}
-        json.dump(CHAMPIONS, open(CHAMPIONS_FILE, "w"))
+        for record in records:
+            CHAMPIONS[record["id"]] = {"name" : record["name"], "time" : record["time"]}
+        CHAMPIONS_STORE.append(records)
+    refresh_champions()
+    if CHAMPIONS_STORE.needs_compaction(len(CHAMPIONS)):
+        CHAMPIONS_STORE.compact_in_background()
+
+def cache_metrics():
+    """Collects the usage of every cache as metrics"""
+    hits = metrics.Counter("cache_hits_total", "Lookups found in the cache.", ("cache",))
+    stale_hits = metrics.Counter("cache_stale_hits_total",
+                                 "Lookups served stale from the cache while refreshed.", ("cache",))
+    misses = metrics.Counter("cache_misses_total", "Lookups missing from the cache.", ("cache",))
+    evictions = metrics.Counter("cache_evictions_total", "Entries evicted to stay in bounds.",
+                                ("cache",))
+    entries = metrics.Gauge("cache_entries", "Entries in the cache.", ("cache",))
+    size = metrics.Gauge("cache_bytes", "Approximate memory used by the cache.", ("cache",))
+
+    for name, ttl_cache in TTL_CACHES.items():
+        stats = ttl_cache.stats()
+        hits.set(stats["hits"], name)
+        stale_hits.set(stats["stale_hits"], name)
+        misses.set(stats["misses"], name)
+        evictions.set(stats["evictions"], name)
+        entries.set(stats["entries"], name)
+        if ttl_cache.max_bytes is not None:
+            size.set(stats["bytes"], name)
+
+    stats = NEGATIVES.stats()
+    hits.set(stats["hits"], "negative")
+    misses.set(stats["misses"], "negative")
+    evictions.set(stats["evictions"], "negative")
+    entries.set(stats["entries"], "negative")
+
+    hits.set(CHAMPIONS_STATS["hits"], "champions")
+    stale_hits.set(CHAMPIONS_STATS["stale_hits"], "champions")
+    misses.set(CHAMPIONS_STATS["misses"], "champions")
+    entries.set(len(CHAMPIONS), "champions")
+    return [hits, stale_hits, misses, evictions, entries, size]
+
+metrics.REGISTRY.register_collector(cache_metrics)
 
 def curr_time_long():
     """Returns current time without decimal part"""
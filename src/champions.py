@@ -0,0 +1,46 @@
+"""Preloads the champion catalog and keeps it fresh in the background."""
+import logging
+import os
+import threading
+import time
+import cache
+import config
+import LoL
+
+LOGGER = logging.getLogger(__name__)
+REFRESHER_LOCK_FILE = os.path.join(cache.CACHE_DIR, "champions-refresher.lock")
+
+def preload(region):
+    """Loads every champion name into the cache with a single API call"""
+    names = LoL.get_champion_list(region)
+    cache.add_champion_names(names)
+    return len(names)
+
+def refresh_forever(region, interval):
+    """Reloads the champion catalog every interval seconds from a single worker process.
+    The other workers pick the champions up from the store, and take over if it exits."""
+    while True:
+        with cache.file_lock(REFRESHER_LOCK_FILE, exclusive=True, blocking=False) as leader:
+            if leader:
+                refresh_as_leader(region, interval)
+        time.sleep(interval)
+
+def refresh_as_leader(region, interval):
+    """Reloads the champion catalog every interval seconds, holding the refresher lock"""
+    while True:
+        try:
+            count = preload(region)
+            LOGGER.info("Loaded %d champions", count)
+        except Exception:
+            LOGGER.exception("Could not load the champion catalog")
+        time.sleep(interval)
+
+def start_refresher():
+    """Starts the background thread keeping the champion catalog fresh"""
+    conf = config.load_from_env()
+    thread = threading.Thread(target=refresh_forever,
+                              args=(conf["CHAMPIONS_REGION"], conf["CHAMPIONS_REFRESH_INTERVAL"]),
+                              name="champions-refresher")
+    thread.daemon = True
+    thread.start()
+    return thread
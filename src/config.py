@@ -3,5 +3,37 @@ import os
 
 def load_from_env():
     """Loads the configuration variables from the enviroment."""
-    config = {"API_KEY" : os.getenv("API_KEY")}
+    config = {"API_KEY" : os.getenv("API_KEY"),
+              "API_BASE_URL" : os.getenv("API_BASE_URL",
+                                         "https://{queryRegion}.api.riotgames.com/lol"),
+              "LOOKUP_POOL_SIZE" : int(os.getenv("LOOKUP_POOL_SIZE", "20")),
+              "LOOKUP_REGION_CONCURRENCY" : int(os.getenv("LOOKUP_REGION_CONCURRENCY", "10")),
+              "LOOKUP_TIMEOUT" : float(os.getenv("LOOKUP_TIMEOUT", "10")),
+              "ASYNC_POOL_SIZE" : int(os.getenv("ASYNC_POOL_SIZE", "40")),
+              "ASYNC_REGION_CONCURRENCY" : int(os.getenv("ASYNC_REGION_CONCURRENCY", "20")),
+              "BATCH_MAX_SIZE" : int(os.getenv("BATCH_MAX_SIZE", "50")),
+              "BATCH_TIMEOUT" : float(os.getenv("BATCH_TIMEOUT", "30")),
+              "HTTP_POOL_SIZE" : int(os.getenv("HTTP_POOL_SIZE", "20")),
+              "HTTP_CONNECT_TIMEOUT" : float(os.getenv("HTTP_CONNECT_TIMEOUT", "3.05")),
+              "HTTP_READ_TIMEOUT" : float(os.getenv("HTTP_READ_TIMEOUT", "10")),
+              "REGION_MAX_CONCURRENT" : int(os.getenv("REGION_MAX_CONCURRENT", "20")),
+              "REGION_FAILURE_THRESHOLD" : int(os.getenv("REGION_FAILURE_THRESHOLD", "5")),
+              "REGION_COOLDOWN" : float(os.getenv("REGION_COOLDOWN", "30")),
+              "HEDGE_PERCENTILE" : float(os.getenv("HEDGE_PERCENTILE", "0")),
+              "APP_RATE_LIMITS" : os.getenv("APP_RATE_LIMITS", "20:1,100:120"),
+              "METHOD_RATE_LIMITS" : os.getenv("METHOD_RATE_LIMITS", ""),
+              "RATE_LIMIT_MAX_WAIT" : float(os.getenv("RATE_LIMIT_MAX_WAIT", "2")),
+              "MATCH_STORE_MAX_BYTES" : int(os.getenv("MATCH_STORE_MAX_BYTES",
+                                                      str(256 * 1024 * 1024))),
+              "REFRESH_POOL_SIZE" : int(os.getenv("REFRESH_POOL_SIZE", "4")),
+              "REFRESH_MAX_PENDING" : int(os.getenv("REFRESH_MAX_PENDING", "100")),
+              "COMPRESS_MIN_SIZE" : int(os.getenv("COMPRESS_MIN_SIZE", "1024")),
+              "SHARED_CACHE_FILE" : os.getenv("SHARED_CACHE_FILE", ""),
+              "TRACE_REQUESTS" : os.getenv("TRACE_REQUESTS", "") not in ("", "0"),
+              "WATCHLIST" : os.getenv("WATCHLIST", ""),
+              "WATCHLIST_INTERVAL" : float(os.getenv("WATCHLIST_INTERVAL", "60")),
+              "WATCHLIST_BUDGET" : float(os.getenv("WATCHLIST_BUDGET", "0.25")),
+              "CHAMPIONS_REGION" : os.getenv("CHAMPIONS_REGION", "NA"),
+              "CHAMPIONS_REFRESH_INTERVAL" : float(os.getenv("CHAMPIONS_REFRESH_INTERVAL",
+                                                             "86400"))}
     return config
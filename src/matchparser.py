@@ -0,0 +1,175 @@
+"""Parses only the needed fields of a match straight from the response byte stream."""
+import json
+import re
+
+#Fields of a match used by the app, True marks a value decoded as a whole
+MATCH_FIELDS = {"gameId" : True,
+                "participantIdentities" : [{"participantId" : True,
+                                            "player" : {"summonerName" : True,
+                                                        "summonerId" : True}}],
+                "participants" : [{"participantId" : True,
+                                   "teamId" : True,
+                                   "championId" : True}]}
+
+STRUCTURE = re.compile(r'["{}\[\]]')
+STRING_END = re.compile(r'["\\]')
+SCALAR_END = re.compile(r'[,}\]\s]')
+WHITESPACE = " \t\r\n"
+
+class StreamParser(object):
+    """Pull parser decoding only the fields of a spec from chunks of JSON text.
+    Skipped values are scanned without being decoded, and only the chunks not
+    parsed yet are kept in memory."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.pos = 0
+        self.mark = None
+
+    def more(self):
+        """Appends the next chunk to the buffer, dropping what was already parsed.
+        Returns False if there are no more chunks."""
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+
+        drop = self.pos if self.mark is None else self.mark
+        self.buffer = self.buffer[drop:] + chunk
+        self.pos -= drop
+        if self.mark is not None:
+            self.mark -= drop
+        return True
+
+    def peek(self):
+        """Returns the next character which isn't whitespace"""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.more():
+                raise ValueError("Unexpected end of JSON")
+
+    def expect(self, char):
+        """Consumes the next character, which must be char"""
+        if self.peek() != char:
+            raise ValueError("Expected '{char}' at position {pos}".format(char=char, pos=self.pos))
+        self.pos += 1
+
+    def search(self, pattern):
+        """Moves to the next match of pattern, reading chunks as needed"""
+        while True:
+            match = pattern.search(self.buffer, self.pos)
+            if match is not None:
+                self.pos = match.start()
+                return match.group()
+            self.pos = len(self.buffer)
+            if not self.more():
+                raise ValueError("Unexpected end of JSON")
+
+    def skip_string(self):
+        """Moves past the string starting at the current position"""
+        self.pos += 1
+        while True:
+            if self.search(STRING_END) == '"':
+                self.pos += 1
+                return
+            while self.pos + 1 >= len(self.buffer):
+                if not self.more():
+                    raise ValueError("Unexpected end of JSON")
+            self.pos += 2 #Escaped character
+
+    def skip_value(self):
+        """Moves past the value starting at the next character"""
+        char = self.peek()
+        if char == '"':
+            self.skip_string()
+            return
+
+        if char not in "{[":
+            while True:
+                match = SCALAR_END.search(self.buffer, self.pos)
+                if match is not None:
+                    self.pos = match.start()
+                    return
+                self.pos = len(self.buffer)
+                if not self.more():
+                    return
+
+        depth = 0
+        while True:
+            char = self.search(STRUCTURE)
+            if char == '"':
+                self.skip_string()
+                continue
+            self.pos += 1
+            depth += 1 if char in "{[" else -1
+            if depth == 0:
+                return
+
+    def decode_value(self):
+        """Decodes the value starting at the next character"""
+        self.peek()
+        self.mark = self.pos
+        try:
+            self.skip_value()
+            return json.loads(self.buffer[self.mark:self.pos])
+        finally:
+            self.mark = None
+
+    def parse(self, spec):
+        """Parses the next value, keeping only the fields in spec"""
+        if spec is True:
+            return self.decode_value()
+
+        if isinstance(spec, list):
+            return self.parse_array(spec[0])
+
+        return self.parse_object(spec)
+
+    def parse_object(self, spec):
+        """Parses an object, keeping only the keys in spec"""
+        result = {}
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return result
+
+        while True:
+            if self.peek() != '"':
+                raise ValueError("Expected key at position {pos}".format(pos=self.pos))
+            key = self.decode_value()
+            self.expect(":")
+            if key in spec:
+                result[key] = self.parse(spec[key])
+            else:
+                self.skip_value()
+
+            char = self.peek()
+            self.pos += 1
+            if char == "}":
+                return result
+            if char != ",":
+                raise ValueError("Expected ',' or '}}' at position {pos}".format(pos=self.pos))
+
+    def parse_array(self, spec):
+        """Parses an array, keeping only the fields in spec of each item"""
+        result = []
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return result
+
+        while True:
+            result.append(self.parse(spec))
+            char = self.peek()
+            self.pos += 1
+            if char == "]":
+                return result
+            if char != ",":
+                raise ValueError("Expected ',' or ']' at position {pos}".format(pos=self.pos))
+
+def parse_match(chunks):
+    """Parses the fields of MATCH_FIELDS from chunks of a match JSON"""
+    return StreamParser(chunks).parse(MATCH_FIELDS)
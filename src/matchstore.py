@@ -0,0 +1,124 @@
+"""Persists finished matches on disk as compressed compact records."""
+import json
+import logging
+import os
+import tempfile
+import threading
+import zlib
+import cache
+import config
+
+LOGGER = logging.getLogger(__name__)
+
+class MatchStore(object):
+    """Stores one zlib compressed JSON file per (region, match ID).
+    Files are written to a temporary name and renamed into place, so any number of
+    processes can read them without locks. When the files take more than max_bytes
+    the oldest ones are removed by a background thread.
+    Storing is best-effort: the store is only a cache of the API."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = None
+        self.evictor = None
+
+    def path(self, region, match_id):
+        """Returns the file of a match"""
+        return os.path.join(self.directory, region, "{id}.json.z".format(id=match_id))
+
+    def get(self, region, match_id):
+        """Returns a stored match, or None if it isn't stored or can't be read"""
+        path = self.path(region, match_id)
+        try:
+            with open(path, "rb") as stored:
+                return json.loads(zlib.decompress(stored.read()))
+        except IOError:
+            return None
+        except (ValueError, zlib.error):
+            self.remove(path)
+            return None
+
+    def put(self, region, match_id, match):
+        """Stores a match, logging the errors instead of raising them"""
+        data = zlib.compress(json.dumps(match, separators=(",", ":")))
+        try:
+            self.write(self.path(region, match_id), data)
+        except (IOError, OSError):
+            LOGGER.warning("Could not store match %s of %s", match_id, region, exc_info=True)
+            return
+
+        with self.lock:
+            if self.size is not None:
+                self.size += len(data)
+            over_size = self.size is None or self.size > self.max_bytes
+        if over_size:
+            self.evict_in_background()
+
+    def write(self, path, data):
+        """Writes a file through a temporary file renamed into place"""
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory): #Created by another process meanwhile
+                    raise
+
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            try:
+                os.write(handle, data)
+            finally:
+                os.close(handle)
+            os.rename(temp_path, path)
+        except (IOError, OSError): #Already stored on Windows, where rename doesn't overwrite
+            self.remove(temp_path)
+            if not os.path.exists(path):
+                raise
+
+    def evict_in_background(self):
+        """Counts the stored files and evicts the oldest in a separate thread,
+        unless it is already running"""
+        with self.lock:
+            if self.evictor is not None and self.evictor.is_alive():
+                return self.evictor
+            self.evictor = threading.Thread(target=self.evict, name="match-store-eviction")
+            self.evictor.daemon = True
+            self.evictor.start()
+            return self.evictor
+
+    def evict(self):
+        """Recounts the stored files, which other processes may have changed, and removes
+        the oldest ones until under 90% of max_bytes"""
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(file_size for _, file_size, _ in files)
+        if size > self.max_bytes:
+            for _, file_size, path in sorted(files):
+                if size <= self.max_bytes * 0.9:
+                    break
+                self.remove(path)
+                size -= file_size
+
+        with self.lock:
+            self.size = size
+
+    def remove(self, path):
+        """Removes a file, if it still exists"""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+MATCH_STORE_DIR = os.path.join(cache.CACHE_DIR, "matches")
+MATCHES = MatchStore(MATCH_STORE_DIR, config.load_from_env()["MATCH_STORE_MAX_BYTES"])
@@ -0,0 +1,345 @@
+"""Collects counters, gauges and timing histograms, exposed in Prometheus format.
+With several worker processes, each one publishes its samples to a shared SQLite
+database, so whichever worker is scraped renders the metrics of all of them.
+Also traces the time spent in each phase of a request, when enabled."""
+from collections import OrderedDict
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger(__name__)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PUBLISH_INTERVAL = 5 #Seconds between publications of the samples of a worker
+LIVE_AFTER = 3 * PUBLISH_INTERVAL #Gauges of workers silent for longer are not rendered
+RETIRE_AFTER = 600 #Counters of workers silent for longer are merged into "retired"
+BUSY_TIMEOUT = 1 #Seconds to wait for the database while another worker writes to it
+
+class Metric(object):
+    """Values of a metric for each combination of label values."""
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def samples(self):
+        """Returns (suffix, labels, value) for every sample of the metric"""
+        with self.lock:
+            return [("", zip(self.labels, key), value)
+                    for key, value in sorted(self.values.items())]
+
+class Counter(Metric):
+    """Value which only goes up."""
+    kind = "counter"
+
+    def inc(self, amount=1, *label_values):
+        """Increments the value for the label values"""
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def set(self, value, *label_values):
+        """Sets the value for the label values, for collected counters"""
+        with self.lock:
+            self.values[label_values] = value
+
+class Gauge(Metric):
+    """Value which goes up and down."""
+    kind = "gauge"
+
+    def inc(self, amount=1, *label_values):
+        """Increments the value for the label values"""
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, amount=1, *label_values):
+        """Decrements the value for the label values"""
+        self.inc(-amount, *label_values)
+
+    def set(self, value, *label_values):
+        """Sets the value for the label values"""
+        with self.lock:
+            self.values[label_values] = value
+
+class Collected(Metric):
+    """Metric whose samples were computed elsewhere, like the sum over every worker."""
+
+    def __init__(self, name, documentation, kind, samples):
+        Metric.__init__(self, name, documentation)
+        self.kind = kind
+        self.collected = samples
+
+    def samples(self):
+        """Returns the collected samples"""
+        return self.collected
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        """Adds an observation for the label values"""
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [[0] * len(self.buckets), 0, 0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[0][index] += 1
+            counts[1] += 1
+            counts[2] += value
+
+    def samples(self):
+        """Returns the bucket, count and sum samples"""
+        samples = []
+        with self.lock:
+            for key, (buckets, count, total) in sorted(self.values.items()):
+                labels = zip(self.labels, key)
+                for bound, bucket_count in zip(self.buckets, buckets):
+                    samples.append(("_bucket", labels + [("le", repr(float(bound)))],
+                                    bucket_count))
+                samples.append(("_bucket", labels + [("le", "+Inf")], count))
+                samples.append(("_count", labels, count))
+                samples.append(("_sum", labels, total))
+        return samples
+
+class Registry(object):
+    """Metrics and collectors rendered by the /metrics endpoint."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        """Adds a metric"""
+        self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """Adds a function returning metrics computed when rendering"""
+        self.collectors.append(collector)
+
+    def collect(self):
+        """Returns every metric, including the ones of the collectors"""
+        metrics = list(self.metrics)
+        for collector in self.collectors:
+            metrics.extend(collector())
+        return metrics
+
+    def render(self):
+        """Renders every metric in the Prometheus text format"""
+        return render(self.collect())
+
+class SharedSamples(object):
+    """Latest samples published by every worker process, in a local SQLite database.
+    Counters and histograms are summed over the workers, including the ones which
+    exited, so they never go down between scrapes; gauges are rendered per worker,
+    with a 'worker' label, for the workers which published recently."""
+
+    def __init__(self, path, worker):
+        self.path = path
+        self.worker = worker
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def database(self):
+        """Returns the connection to the database, opening it on first use"""
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS metric_samples (worker TEXT, "
+                               "name TEXT, kind TEXT, doc TEXT, suffix TEXT, labels TEXT, "
+                               "value REAL, updated REAL, "
+                               "PRIMARY KEY (worker, name, suffix, labels))")
+            self.connection = connection
+        return self.connection
+
+    def publish(self, metrics):
+        """Replaces the samples of this worker with the current ones"""
+        now = time.time()
+        rows = [(self.worker, metric.name, metric.kind, metric.documentation, suffix,
+                 json.dumps(labels), float(value), now)
+                for metric in metrics for suffix, labels, value in metric.samples()]
+        with self.lock:
+            connection = self.database()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("DELETE FROM metric_samples WHERE worker = ?", (self.worker,))
+                connection.executemany("INSERT OR REPLACE INTO metric_samples VALUES "
+                                       "(?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+
+    def retire(self, connection, now):
+        """Merges the counters and histograms of the workers silent for RETIRE_AFTER
+        seconds into the "retired" worker, and removes their samples"""
+        stale = [row[0] for row in connection.execute(
+            "SELECT worker FROM metric_samples WHERE worker != 'retired' GROUP BY worker "
+            "HAVING MAX(updated) < ?", (now - RETIRE_AFTER,))]
+        for worker in stale:
+            connection.execute("INSERT OR IGNORE INTO metric_samples SELECT 'retired', name, "
+                               "kind, doc, suffix, labels, 0, 0 FROM metric_samples "
+                               "WHERE worker = ? AND kind != 'gauge'", (worker,))
+            connection.execute("UPDATE metric_samples SET value = value + (SELECT old.value "
+                               "FROM metric_samples AS old WHERE old.worker = ? AND "
+                               "old.name = metric_samples.name AND "
+                               "old.suffix = metric_samples.suffix AND "
+                               "old.labels = metric_samples.labels AND old.kind != 'gauge') "
+                               "WHERE worker = 'retired' AND EXISTS (SELECT 1 "
+                               "FROM metric_samples AS old WHERE old.worker = ? AND "
+                               "old.name = metric_samples.name AND "
+                               "old.suffix = metric_samples.suffix AND "
+                               "old.labels = metric_samples.labels AND old.kind != 'gauge')",
+                               (worker, worker))
+            connection.execute("DELETE FROM metric_samples WHERE worker = ?", (worker,))
+
+    def combined(self):
+        """Returns the metrics of every worker"""
+        now = time.time()
+        with self.lock:
+            connection = self.database()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.retire(connection, now)
+                rows = connection.execute("SELECT worker, name, kind, doc, suffix, labels, "
+                                          "value, updated FROM metric_samples "
+                                          "ORDER BY worker, rowid").fetchall()
+                connection.execute("COMMIT")
+            except sqlite3.Error:
+                connection.execute("ROLLBACK")
+                raise
+
+        metrics = OrderedDict()
+        for worker, name, kind, doc, suffix, labels, value, updated in rows:
+            labels = [tuple(label) for label in json.loads(labels)]
+            if kind == "gauge":
+                if updated < now - LIVE_AFTER:
+                    continue
+                labels.append(("worker", worker))
+            samples = metrics.setdefault(name, (kind, doc, OrderedDict()))[2]
+            key = (suffix, tuple(labels))
+            samples[key] = samples.get(key, 0) + value
+        return [Collected(name, doc, kind,
+                          [(suffix, list(labels), value)
+                           for (suffix, labels), value in samples.items()])
+                for name, (kind, doc, samples) in metrics.items()]
+
+def render(metrics):
+    """Renders metrics in the Prometheus text format"""
+    lines = []
+    for metric in metrics:
+        lines.append("# HELP {name} {doc}".format(name=metric.name, doc=metric.documentation))
+        lines.append("# TYPE {name} {kind}".format(name=metric.name, kind=metric.kind))
+        for suffix, labels, value in metric.samples():
+            lines.append("{name}{suffix}{labels} {value}".format(
+                name=metric.name, suffix=suffix, labels=format_labels(labels),
+                value=repr(float(value))))
+    return "\n".join(lines) + "\n"
+
+def render_all():
+    """Renders the metrics of every worker if they are shared, else of this process"""
+    if SHARED is not None:
+        try:
+            SHARED.publish(REGISTRY.collect())
+            return render(SHARED.combined())
+        except sqlite3.Error:
+            LOGGER.warning("Could not read the metrics of the other workers", exc_info=True)
+    return REGISTRY.render()
+
+def publish_forever(shared):
+    """Publishes the samples of this worker every PUBLISH_INTERVAL seconds"""
+    while True:
+        try:
+            shared.publish(REGISTRY.collect())
+        except sqlite3.Error:
+            LOGGER.warning("Could not publish the metrics of this worker", exc_info=True)
+        time.sleep(PUBLISH_INTERVAL)
+
+def start_publisher(path):
+    """Shares the metrics of this worker through the database at path, if there is one,
+    starting the background thread publishing them"""
+    global SHARED
+    if not path:
+        return None
+    SHARED = SharedSamples(path, "{pid}-{started}".format(pid=os.getpid(),
+                                                          started=int(time.time())))
+    thread = threading.Thread(target=publish_forever, args=(SHARED,), name="metrics-publisher")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def format_labels(labels):
+    """Formats labels as {name="value",...}"""
+    if not labels:
+        return ""
+    return "{" + ",".join('{name}="{value}"'.format(
+        name=name, value=unicode(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in labels) + "}"
+
+REGISTRY = Registry()
+SHARED = None
+
+UPSTREAM_DURATION = REGISTRY.register(Histogram(
+    "lol_api_request_duration_seconds", "Duration of calls to the LoL API.",
+    ("region", "method", "status")))
+UPSTREAM_IN_FLIGHT = REGISTRY.register(Gauge(
+    "lol_api_requests_in_flight", "Calls to the LoL API waiting for a response.", ("region",)))
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    "gamedata_request_duration_seconds", "Duration of game data requests.",
+    ("handler", "status")))
+REQUESTS_IN_FLIGHT = REGISTRY.register(Gauge(
+    "gamedata_requests_in_flight", "Game data requests being served.", ("handler",)))
+
+TRACE = threading.local()
+
+class NullPhase(object):
+    """Phase which doesn't measure anything, used when tracing is off."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_PHASE = NullPhase()
+
+def start_trace():
+    """Starts tracing the phases of the current request"""
+    TRACE.phases = []
+
+def phase(name):
+    """Returns a context measuring a phase of the traced request"""
+    if getattr(TRACE, "phases", None) is None:
+        return NULL_PHASE
+    return timed_phase(name)
+
+@contextmanager
+def timed_phase(name):
+    """Measures a phase of the traced request"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        TRACE.phases.append((name, time.time() - start))
+
+def finish_trace(description):
+    """Logs the phases of the current request and stops tracing"""
+    phases = getattr(TRACE, "phases", None)
+    TRACE.phases = None
+    if phases is not None:
+        LOGGER.info("%s %s", description,
+                    " ".join("{name}={ms:.1f}ms".format(name=name, ms=seconds * 1000)
+                             for name, seconds in phases))
@@ -0,0 +1,103 @@
+"""Runs blocking lookups concurrently on a bounded pool of threads."""
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import logging
+import Queue
+import threading
+import time
+import config
+
+LOGGER = logging.getLogger(__name__)
+POOL = None
+POOL_LOCK = threading.Lock()
+
+class RegionPool(object):
+    """Threads shared by every region, of which a region uses at most per_region at once.
+    The other calls of a busy region wait in its own queue, so slow lookups in one region
+    don't queue the others, and the number of threads doesn't grow with the regions."""
+
+    def __init__(self, size, per_region):
+        self.size = size
+        self.per_region = per_region
+        self.pool = None
+        self.lock = threading.Lock()
+        self.active = {}
+        self.queued = {}
+
+    def apply_async(self, region, func, args=()):
+        """Runs func(*args) on the pool as soon as the region has a free slot"""
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.size)
+            if self.active.get(region, 0) >= self.per_region:
+                self.queued.setdefault(region, deque()).append((func, args))
+                return
+            self.active[region] = self.active.get(region, 0) + 1
+        self.pool.apply_async(self.run, (region, func, args))
+
+    def run(self, region, func, args):
+        """Runs a call, then the calls queued for the region while there are any"""
+        while True:
+            try:
+                func(*args)
+            except Exception:
+                LOGGER.exception("Lookup failed in the %s pool", region)
+            with self.lock:
+                queued = self.queued.get(region)
+                if not queued:
+                    self.active[region] -= 1
+                    return
+                func, args = queued.popleft()
+
+def get_pool():
+    """Returns the lookup pool, creating it on first use"""
+    global POOL
+    with POOL_LOCK:
+        if POOL is None:
+            conf = config.load_from_env()
+            POOL = RegionPool(conf["LOOKUP_POOL_SIZE"], conf["LOOKUP_REGION_CONCURRENCY"])
+        return POOL
+
+def map_ordered(func, items, timeout, region=None):
+    """Applies func to every item concurrently, within the slots of the region in the pool,
+    and returns the results in input order.
+    timeout is a deadline for all the calls together; each call to the LoL API is bounded
+    on its own by the HTTP timeouts.
+    Raises the first exception raised by any call without waiting for the others, and the
+    calls which haven't started yet are then skipped."""
+    results = Queue.Queue()
+    pool = get_pool()
+    cancelled = threading.Event()
+
+    def run(index, item):
+        """Runs a single call, reporting its outcome to the results queue"""
+        if cancelled.is_set():
+            return
+        try:
+            results.put((index, func(item), None))
+        except Exception as ex:
+            results.put((index, None, ex))
+
+    for index, item in enumerate(items):
+        pool.apply_async(region, run, (index, item))
+
+    deadline = time.time() + timeout
+    ordered = [None] * len(items)
+    try:
+        for _ in range(len(items)):
+            try:
+                index, value, error = results.get(timeout=max(deadline - time.time(), 0))
+            except Queue.Empty:
+                raise LookupTimeoutError("Lookups did not finish within {timeout} seconds."
+                                         .format(timeout=timeout))
+            if error is not None:
+                raise error
+            ordered[index] = value
+    except Exception:
+        cancelled.set()
+        raise
+
+    return ordered
+
+class LookupTimeoutError(ValueError):
+    """Raise this when concurrent lookups take longer than allowed."""
@@ -0,0 +1,180 @@
+"""Schedules calls to the LoL API within the application and method rate limits."""
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+BUSY_TIMEOUT = 1 #Seconds to wait for the buckets while another process updates them
+
+class TokenBucket(object):
+    """Allows `capacity` calls per `period` seconds, refilling continuously."""
+
+    def __init__(self, capacity, period):
+        self.capacity = float(capacity)
+        self.period = float(period)
+        self.rate = self.capacity / self.period
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+    def refill(self, now):
+        """Adds the tokens earned since the last update"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Returns how long until a token is available (tokens may be reserved ahead)"""
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        """Reserves a token, possibly one that will only be available in the future"""
+        self.tokens -= 1
+
+class RateLimiter(object):
+    """Keeps token buckets and Retry-After blocks for every rate limit key.
+    Callers reserve a slot in all their buckets at once and then wait for it,
+    which queues concurrent calls in arrival order."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limits = {}
+        self.buckets = {}
+        self.blocked_until = {}
+
+    def set_limits(self, key, limits):
+        """Sets the limits of a key, given as a list of (calls, seconds)"""
+        with self.lock:
+            if self.limits.get(key) == limits:
+                return
+            self.limits[key] = limits
+            self.buckets[key] = [TokenBucket(calls, seconds) for calls, seconds in limits]
+
+    def block(self, key, seconds):
+        """Blocks all calls for a key for the given amount of seconds"""
+        with self.lock:
+            until = time.time() + seconds
+            self.blocked_until[key] = max(until, self.blocked_until.get(key, 0))
+
+    def reserve(self, keys, max_wait):
+        """Reserves a call for all the keys if it can happen within max_wait seconds.
+        Returns a (granted, wait) tuple; nothing is reserved when not granted."""
+        with self.lock:
+            now = time.time()
+            wait = 0.0
+            for key in keys:
+                wait = max(wait, self.blocked_until.get(key, 0) - now)
+                for bucket in self.buckets.get(key, []):
+                    wait = max(wait, bucket.wait_time(now))
+
+            if wait > max_wait:
+                return False, wait
+
+            for key in keys:
+                for bucket in self.buckets.get(key, []):
+                    bucket.take()
+            return True, wait
+
+class SharedRateLimiter(RateLimiter):
+    """Rate limiter whose tokens and blocks are shared by every worker process calling
+    the API with the same key, through a local SQLite database.
+    Each process keeps the limits it knows; the bucket of a limit is identified by its
+    key and period, and is refilled from its last update when a reservation reads it.
+    If the database can't be used, the process falls back to its own buckets."""
+
+    def __init__(self, path):
+        RateLimiter.__init__(self)
+        self.path = path
+        self.connection = None
+
+    def database(self):
+        """Returns the connection to the database, opening it on first use"""
+        if self.connection is None:
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT, "
+                               "period REAL, tokens REAL, updated REAL, "
+                               "PRIMARY KEY (key, period))")
+            connection.execute("CREATE TABLE IF NOT EXISTS rate_blocks (key TEXT PRIMARY KEY, "
+                               "until REAL)")
+            self.connection = connection
+        return self.connection
+
+    def block(self, key, seconds):
+        """Blocks all calls for a key, in every process, for the given amount of seconds"""
+        RateLimiter.block(self, key, seconds)
+        with self.lock:
+            try:
+                connection = self.database()
+                connection.execute("INSERT OR IGNORE INTO rate_blocks (key, until) "
+                                   "VALUES (?, 0)", (json.dumps(key),))
+                connection.execute("UPDATE rate_blocks SET until = MAX(until, ?) WHERE key = ?",
+                                   (self.blocked_until[key], json.dumps(key)))
+            except sqlite3.Error:
+                LOGGER.warning("Could not share the rate limit block of %s", key, exc_info=True)
+
+    def reserve(self, keys, max_wait):
+        """Reserves a call for all the keys in the shared buckets if it can happen within
+        max_wait seconds. Returns a (granted, wait) tuple."""
+        with self.lock:
+            try:
+                return self.reserve_shared(keys, max_wait)
+            except sqlite3.Error:
+                LOGGER.warning("Could not use the shared rate limits", exc_info=True)
+        return RateLimiter.reserve(self, keys, max_wait)
+
+    def reserve_shared(self, keys, max_wait):
+        """Reads, reserves and writes back the buckets of the keys in one transaction"""
+        connection = self.database()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            wait = 0.0
+            for key in keys:
+                row = connection.execute("SELECT until FROM rate_blocks WHERE key = ?",
+                                         (json.dumps(key),)).fetchone()
+                blocked_until = max(row[0] if row is not None else 0,
+                                    self.blocked_until.get(key, 0))
+                wait = max(wait, blocked_until - now)
+                for bucket in self.buckets.get(key, []):
+                    row = connection.execute("SELECT tokens, updated FROM rate_buckets "
+                                             "WHERE key = ? AND period = ?",
+                                             (json.dumps(key), bucket.period)).fetchone()
+                    if row is not None:
+                        bucket.tokens, bucket.updated = min(row[0], bucket.capacity), row[1]
+                    wait = max(wait, bucket.wait_time(now))
+
+            if wait <= max_wait:
+                for key in keys:
+                    for bucket in self.buckets.get(key, []):
+                        bucket.take()
+                        connection.execute("INSERT OR REPLACE INTO rate_buckets (key, period, "
+                                           "tokens, updated) VALUES (?, ?, ?, ?)",
+                                           (json.dumps(key), bucket.period, bucket.tokens,
+                                            bucket.updated))
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+        return wait <= max_wait, wait
+
+def new_rate_limiter(path):
+    """Returns a rate limiter shared through the database at path, or one for this
+    process only if there is none"""
+    if not path:
+        return RateLimiter()
+    return SharedRateLimiter(path)
+
+def parse_limits(header):
+    """Parses a rate limit header like '20:1,100:120' into [(20, 1), (100, 120)]"""
+    limits = []
+    for limit in header.split(","):
+        if ":" not in limit:
+            continue
+        calls, seconds = limit.split(":")
+        limits.append((int(calls), int(seconds)))
+    return limits
@@ -0,0 +1,54 @@
+"""Refreshes stale cache entries in the background on a small bounded pool of threads."""
+from multiprocessing.pool import ThreadPool
+import logging
+import threading
+import config
+import metrics
+
+LOGGER = logging.getLogger(__name__)
+POOL = None
+PENDING = set()
+PENDING_LOCK = threading.Lock()
+REFRESHES = metrics.REGISTRY.register(metrics.Counter(
+    "cache_refreshes_total", "Background refreshes of stale cache entries by outcome.",
+    ("outcome",)))
+
+def get_pool():
+    """Returns the refresh pool, creating it on first use"""
+    global POOL
+    with PENDING_LOCK:
+        if POOL is None:
+            POOL = ThreadPool(config.load_from_env()["REFRESH_POOL_SIZE"])
+        return POOL
+
+def schedule(key, func, *args):
+    """Runs func(*args) in the background unless a refresh of the key is already pending.
+    Refreshes over REFRESH_MAX_PENDING are dropped: the stale value keeps being served
+    and a later lookup schedules the refresh again. Returns if it was scheduled."""
+    pool = get_pool()
+    with PENDING_LOCK:
+        if key in PENDING:
+            return False
+        if len(PENDING) >= config.load_from_env()["REFRESH_MAX_PENDING"]:
+            REFRESHES.inc(1, "dropped")
+            return False
+        PENDING.add(key)
+    pool.apply_async(run, (key, func, args))
+    return True
+
+def run(key, func, args):
+    """Runs a refresh, allowing the key to be refreshed again once it is done"""
+    try:
+        func(*args)
+        REFRESHES.inc(1, "ok")
+    except Exception:
+        LOGGER.warning("Could not refresh %s", key, exc_info=True)
+        REFRESHES.inc(1, "error")
+    finally:
+        with PENDING_LOCK:
+            PENDING.discard(key)
+
+def pending():
+    """Returns the number of refreshes waiting or running"""
+    with PENDING_LOCK:
+        return len(PENDING)
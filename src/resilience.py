@@ -0,0 +1,251 @@
+"""Isolates the regions of the LoL API from each other. Each region gets its own limit
+of concurrent calls, read timeouts adapted to the latency of each of its methods, a
+circuit breaker and hedged calls, so a slow region can't tie up the workers serving
+the others."""
+from multiprocessing.pool import ThreadPool
+import collections
+import Queue
+import threading
+import time
+import config
+import metrics
+
+LATENCY_WINDOW = 200 #Latest call durations kept per region and method
+LATENCY_MIN_SAMPLES = 20 #Durations of a method needed before adapting its timeout or hedging
+TIMEOUT_PERCENTILE = 0.99
+TIMEOUT_MULTIPLIER = 3 #Read timeout is 3 times the 99th percentile latency
+MIN_READ_TIMEOUT = 1.0
+BULKHEAD_MAX_WAIT = 1.0 #Seconds to wait for a free slot in a region before failing
+
+GUARDS = {}
+GUARDS_LOCK = threading.Lock()
+HEDGES = metrics.REGISTRY.register(metrics.Counter(
+    "upstream_hedged_requests_total", "Second calls sent for slow LoL API calls.", ("region",)))
+
+class Bulkhead(object):
+    """Limits the number of concurrent calls."""
+
+    def __init__(self, size):
+        self.size = size
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, timeout):
+        """Takes a slot, waiting at most timeout seconds. Returns if it got one."""
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.active >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.active += 1
+            return True
+
+    def release(self):
+        """Frees a slot"""
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+class LatencyTracker(object):
+    """Keeps the durations of the latest calls to compute percentiles."""
+
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.durations = collections.deque(maxlen=size)
+
+    def observe(self, seconds):
+        """Records the duration of a call"""
+        with self.lock:
+            self.durations.append(seconds)
+
+    def percentile(self, fraction):
+        """Returns the duration under which the given fraction of calls finished,
+        or None until there are enough calls"""
+        with self.lock:
+            durations = sorted(self.durations)
+        if len(durations) < LATENCY_MIN_SAMPLES:
+            return None
+        return durations[min(int(fraction * len(durations)), len(durations) - 1)]
+
+class CircuitBreaker(object):
+    """Opens after threshold consecutive failures, failing calls fast for cooldown seconds.
+    Then lets a single trial call through, which closes the circuit if it succeeds and
+    opens it again otherwise."""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def allow(self):
+        """Checks if a call can go through, starting the trial call after the cooldown"""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or time.time() - self.opened_at < self.cooldown:
+                return False
+            self.trial = True
+            return True
+
+    def record(self, success):
+        """Records the outcome of a call"""
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.trial or self.failures >= self.threshold:
+                    self.opened_at = time.time()
+            self.trial = False
+
+    def retry_after(self):
+        """Returns the seconds until the trial call is allowed"""
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            return max(self.cooldown - (time.time() - self.opened_at), 0)
+
+    def is_open(self):
+        """Checks if calls are being failed fast"""
+        with self.lock:
+            return self.opened_at is not None
+
+class RegionGuard(object):
+    """Protections of the calls to a single region."""
+
+    def __init__(self, region):
+        conf = config.load_from_env()
+        self.region = region
+        self.bulkhead = Bulkhead(conf["REGION_MAX_CONCURRENT"])
+        self.breaker = CircuitBreaker(conf["REGION_FAILURE_THRESHOLD"], conf["REGION_COOLDOWN"])
+        self.latencies = {}
+        self.max_read_timeout = conf["HTTP_READ_TIMEOUT"]
+        self.hedge_percentile = conf["HEDGE_PERCENTILE"]
+        self.pool_size = 2 * conf["REGION_MAX_CONCURRENT"] #Room for a hedge per call
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def latency(self, method):
+        """Returns the latency tracker of a method, creating it on first use.
+        Methods are tracked apart so fast calls don't shorten the timeout of slow ones."""
+        with self.lock:
+            if method not in self.latencies:
+                self.latencies[method] = LatencyTracker(LATENCY_WINDOW)
+            return self.latencies[method]
+
+    def read_timeout(self, method):
+        """Returns the read timeout for calls to a method, a multiple of its observed tail
+        latency within [MIN_READ_TIMEOUT, HTTP_READ_TIMEOUT]"""
+        tail = self.latency(method).percentile(TIMEOUT_PERCENTILE)
+        if tail is None:
+            return self.max_read_timeout
+        return min(max(tail * TIMEOUT_MULTIPLIER, MIN_READ_TIMEOUT), self.max_read_timeout)
+
+    def hedge_delay(self, method):
+        """Returns how long to wait for a call to a method before hedging it, or None not
+        to hedge"""
+        if not self.hedge_percentile:
+            return None
+        return self.latency(method).percentile(self.hedge_percentile)
+
+    def record(self, success, seconds, method):
+        """Records the outcome and duration of a call to a method"""
+        self.breaker.record(success)
+        self.latency(method).observe(seconds)
+
+    def get_pool(self):
+        """Returns the pool running the hedged calls of the region, creating it on first use"""
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.pool_size)
+            return self.pool
+
+    def first_of(self, call, delay, hedge_allowed, discard):
+        """Runs call() and, if it hasn't finished after delay seconds and hedge_allowed()
+        agrees, a second call(). Returns the first result, or raises the error of the
+        last call to fail. Results arriving too late are passed to discard."""
+        pool = self.get_pool()
+        outcomes = Queue.Queue()
+        lock = threading.Lock()
+        finished = [False]
+
+        def run():
+            """Runs a call, handing its outcome over unless a result was already returned"""
+            try:
+                outcome = (call(), None)
+            except Exception as ex:
+                outcome = (None, ex)
+            with lock:
+                if not finished[0]:
+                    outcomes.put(outcome)
+                    return
+            if outcome[0] is not None:
+                discard(outcome[0])
+
+        def finish(outcome):
+            """Stops accepting outcomes, discarding the ones already in, and returns"""
+            with lock:
+                finished[0] = True
+                while not outcomes.empty():
+                    late = outcomes.get_nowait()[0]
+                    if late is not None:
+                        discard(late)
+            if outcome[1] is not None:
+                raise outcome[1]
+            return outcome[0]
+
+        pool.apply_async(run)
+        try:
+            return finish(outcomes.get(timeout=delay))
+        except Queue.Empty:
+            pass
+
+        if not hedge_allowed():
+            return finish(outcomes.get())
+
+        HEDGES.inc(1, self.region)
+        pool.apply_async(run)
+        outcome = outcomes.get()
+        if outcome[1] is not None:
+            outcome = outcomes.get()
+        return finish(outcome)
+
+def get_guard(region):
+    """Returns the guard of a region, creating it on first use"""
+    with GUARDS_LOCK:
+        if region not in GUARDS:
+            GUARDS[region] = RegionGuard(region)
+        return GUARDS[region]
+
+def reset():
+    """Forgets the state of every region"""
+    with GUARDS_LOCK:
+        GUARDS.clear()
+
+def region_metrics():
+    """Collects the state of every region as metrics"""
+    circuit_open = metrics.Gauge("upstream_circuit_open",
+                                 "Whether calls to the region are failed fast.", ("region",))
+    read_timeout = metrics.Gauge("upstream_read_timeout_seconds",
+                                 "Adaptive read timeout of a method of the region.",
+                                 ("region", "method"))
+    active = metrics.Gauge("upstream_bulkhead_active", "Calls using a slot of the region.",
+                           ("region",))
+    with GUARDS_LOCK:
+        guards = GUARDS.values()
+    for guard in guards:
+        circuit_open.set(int(guard.breaker.is_open()), guard.region)
+        with guard.lock:
+            methods = guard.latencies.keys()
+        for method in methods:
+            read_timeout.set(guard.read_timeout(method), guard.region, method)
+        active.set(guard.bulkhead.active, guard.region)
+    return [circuit_open, read_timeout, active]
+
+metrics.REGISTRY.register_collector(region_metrics)
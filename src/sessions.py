@@ -0,0 +1,47 @@
+"""Keeps a persistent pool of HTTP connections for each regional API host."""
+import threading
+import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+import config
+
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
+def get_session(host):
+    """Returns the session for a host, creating it on first use"""
+    session = SESSIONS.get(host)
+    if session is not None:
+        return session
+
+    with SESSIONS_LOCK:
+        if host not in SESSIONS:
+            SESSIONS[host] = new_session()
+        return SESSIONS[host]
+
+def new_session():
+    """Creates a session keeping alive up to HTTP_POOL_SIZE connections"""
+    conf = config.load_from_env()
+    adapter = HTTPAdapter(pool_connections=1,
+                          pool_maxsize=conf["HTTP_POOL_SIZE"],
+                          pool_block=False)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get(url, params, stream=False, read_timeout=None):
+    """Gets request to the url through the session of its host.
+    The read timeout defaults to HTTP_READ_TIMEOUT."""
+    conf = config.load_from_env()
+    host = urlparse.urlparse(url).netloc
+    timeout = (conf["HTTP_CONNECT_TIMEOUT"],
+               read_timeout if read_timeout is not None else conf["HTTP_READ_TIMEOUT"])
+    return get_session(host).get(url, params=params, timeout=timeout, stream=stream)
+
+def close_all():
+    """Closes every pooled connection"""
+    with SESSIONS_LOCK:
+        for session in SESSIONS.values():
+            session.close()
+        SESSIONS.clear()
@@ -0,0 +1,113 @@
+"""Cache shared by every worker process, stored in a local SQLite database.
+SQLite takes care of locking between processes, and the database file is memory
+mapped so reads from any worker are served from the page cache.
+As it is only a second level of cache, database errors are logged and treated as
+misses, and writers don't wait long for a locked database."""
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+BUSY_TIMEOUT = 0.1 #Seconds to wait for a lock held by another process
+
+class SharedCache(object):
+    """Stores JSON values with an expiration time in a table of the database.
+    Each thread uses its own connection. Invalidating a key bumps a generation
+    number which lets the other processes know their copies are stale.
+    Values are kept grace seconds after expiring, for stale-while-revalidate."""
+
+    def __init__(self, path, table, max_entries, grace=0, purge_every=1000):
+        self.path = path
+        self.table = table
+        self.max_entries = max_entries
+        self.grace = grace
+        self.purge_every = purge_every
+        self.writes = 0
+        self.last_generation = 0
+        self.local = threading.local()
+        try:
+            self.execute("CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, "
+                         "value TEXT, expires REAL, stored REAL)")
+            self.execute("CREATE TABLE IF NOT EXISTS generations (name TEXT PRIMARY KEY, "
+                         "generation INTEGER)")
+        except sqlite3.Error:
+            LOGGER.warning("Could not create the shared %s cache", table, exc_info=True)
+
+    def connection(self):
+        """Returns the connection of the current thread, opening it on first use"""
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA mmap_size=268435456")
+            self.local.connection = connection
+        return connection
+
+    def execute(self, statement, parameters=()):
+        """Runs a statement on the table, returning the cursor"""
+        return self.connection().execute(statement.format(table=self.table), parameters)
+
+    def get_entry(self, key):
+        """Returns the (value, expiration time) of a key, or None if it is missing or
+        expired for longer than the grace period"""
+        try:
+            row = self.execute("SELECT value, expires FROM {table} WHERE key = ?",
+                               (encode_key(key),)).fetchone()
+        except sqlite3.Error:
+            LOGGER.warning("Could not read the shared %s cache", self.table, exc_info=True)
+            return None
+        if row is None or (row[1] is not None and row[1] + self.grace < time.time()):
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, key, value, ttl):
+        """Stores a value for ttl seconds (forever if None)"""
+        now = time.time()
+        expires = now + ttl if ttl is not None else None
+        try:
+            self.execute("INSERT OR REPLACE INTO {table} (key, value, expires, stored) "
+                         "VALUES (?, ?, ?, ?)", (encode_key(key), json.dumps(value), expires, now))
+            self.writes += 1
+            if self.writes % self.purge_every == 0:
+                self.purge()
+        except sqlite3.Error:
+            LOGGER.warning("Could not write to the shared %s cache", self.table, exc_info=True)
+
+    def purge(self):
+        """Removes the expired values and the oldest ones over max_entries"""
+        self.execute("DELETE FROM {table} WHERE expires < ?", (time.time() - self.grace,))
+        self.execute("DELETE FROM {table} WHERE key IN (SELECT key FROM {table} "
+                     "ORDER BY stored DESC, rowid DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def invalidate(self, key=None):
+        """Removes a key (or every key) and bumps the generation of the table"""
+        try:
+            if key is None:
+                self.execute("DELETE FROM {table}")
+            else:
+                self.execute("DELETE FROM {table} WHERE key = ?", (encode_key(key),))
+            self.execute("INSERT OR IGNORE INTO generations (name, generation) VALUES (?, 0)",
+                         (self.table,))
+            self.execute("UPDATE generations SET generation = generation + 1 WHERE name = ?",
+                         (self.table,))
+        except sqlite3.Error:
+            LOGGER.warning("Could not invalidate the shared %s cache", self.table, exc_info=True)
+
+    def generation(self):
+        """Returns the generation of the table, the last one read if it can't be read"""
+        try:
+            row = self.execute("SELECT generation FROM generations WHERE name = ?",
+                               (self.table,)).fetchone()
+        except sqlite3.Error:
+            LOGGER.warning("Could not read the shared %s cache", self.table, exc_info=True)
+            return self.last_generation
+        self.last_generation = row[0] if row is not None else 0
+        return self.last_generation
+
+def encode_key(key):
+    """Encodes a key (a tuple of JSON values) as text"""
+    return json.dumps(key)
@@ -0,0 +1,48 @@
+"""Coalesces concurrent identical calls into a single one."""
+import threading
+
+class Call(object):
+    """Outcome of a call shared by everyone waiting for it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """Runs at most one call per key at a time. Callers arriving while a call with
+    the same key is in flight wait for it and get its result or exception."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, *args):
+        """Calls func(*args), or waits for the call already in flight for key"""
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = Call()
+                self.calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args)
+            return call.result
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def in_flight(self):
+        """Returns how many calls are in flight"""
+        return len(self.calls)
@@ -1,11 +1,3 @@
-$(document)
-    .ajaxStart(function () {
-        $("#loadingDiv").css("display","");
-    })
-    .ajaxStop(function () {
-        $("#loadingDiv").css("display","none");
-    });
-
 function getMatchData () {
     var summoner = $("#summonerName").val();
     var region = $("#region").val();
@@ -20,19 +12,66 @@ function getMatchData () {
 }
 
 function getData(s, r) {
-    $.ajax({
-        url: "gamedata",
-        data: {
-            summoner: s,
-            region: r
-        },
-        success: function(data) {
-            displayResult(data)      
-        },
-        error: function(XMLHttpRequest, textStatus, errorThrown) {
-            displayError(XMLHttpRequest)
+    var xhr = new XMLHttpRequest();
+    var received = 0;
+
+    xhr.open("GET", "gamedata/stream?" + $.param({summoner: s, region: r}));
+    xhr.onprogress = function () {
+        received = readEvents(xhr, received);
+    };
+    xhr.onload = function () {
+        $("#loadingDiv").css("display","none");
+        if (xhr.status != 200) {
+            displayError(xhr);
+            return;
+        }
+        readEvents(xhr, received);
+    };
+    xhr.onerror = function () {
+        $("#loadingDiv").css("display","none");
+        displayError(xhr);
+    };
+    $("#loadingDiv").css("display","");
+    xhr.send();
+}
+
+function readEvents(xhr, received) {
+    if (xhr.status != 200) {
+        return received;
+    }
+
+    var text = xhr.responseText;
+    var end = text.lastIndexOf("\n");
+    if (end < received) {
+        return received;
+    }
+
+    var lines = text.substring(received, end).split("\n");
+    for (var i = 0; i < lines.length; i++) {
+        if (lines[i] != "") {
+            handleEvent(JSON.parse(lines[i]));
         }
-    });
+    }
+    return end + 1;
+}
+
+function handleEvent(event) {
+    if (event.type == "header") {
+        displayHeader();
+    } else if (event.type == "participant") {
+        $("#participantTable").append(createRow(event.participant));
+    } else if (event.type == "complete") {
+        displayResult(event.data);
+    } else if (event.type == "error") {
+        displayError({responseText: JSON.stringify(event.error),
+                      status: event.error.status.status_code});
+    }
+}
+
+function displayHeader() {
+    $("#participantTable").html(headerRow());
+    $("#errorMessage").html("");
+    $("#gamedata").css("display","");
 }
 
 function displayResult(data) {
@@ -56,11 +95,15 @@ function createRow(participant) {
     tr += "<td>" + participant["teamId"]  + "</td>";
     tr += "<td>" + participant["championId"]  + "</td>";
     tr += "<td>" + participant["championName"]  + "</td>";
-    tr += "<td><img class='mastery' src='static/images/Mastery_" + participant["championMastery"] + ".png'></td>";
+    tr += "<td><img class='mastery' src='" + assetUrl("images/Mastery_" + participant["championMastery"] + ".png") + "'></td>";
     tr +="</tr>";
     return tr;
 }
 
+function assetUrl(path) {
+    return (window.ASSETS && window.ASSETS[path]) || "static/" + path;
+}
+
 function displayError(response){
     $("#errorMessage").html("An error occured: " + response.responseText + "<br/> Status Code: " + response.status);
     $("#gamedata").css("display","none");
@@ -0,0 +1,84 @@
+"""Polls the latest match of a watchlist of summoners, warming the caches for each new game."""
+import logging
+import os
+import threading
+import time
+import cache
+import config
+import LoL
+import ratelimit
+
+LOGGER = logging.getLogger(__name__)
+WATCHER_LOCK_FILE = os.path.join(cache.CACHE_DIR, "watchlist.lock")
+
+def parse_watchlist(value):
+    """Parses a watchlist like 'EUW:name,NA:other' into [(region, summoner)]"""
+    watchlist = []
+    for entry in value.split(","):
+        if ":" not in entry:
+            continue
+        region, summoner = entry.split(":", 1)
+        watchlist.append((region.strip().upper(), summoner.strip()))
+    return watchlist
+
+class Watcher(object):
+    """Polls the newest matchlist entry of each summoner in turn, and calls
+    prewarm(region, summoner, game_id) when the response for that game isn't cached."""
+
+    def __init__(self, watchlist, prewarm, interval, budget):
+        self.watchlist = watchlist
+        self.prewarm = prewarm
+        self.interval = interval
+        self.budget = budget
+
+    def poll(self, region, summoner):
+        """Checks the latest game of a summoner, prewarming it if its response isn't cached,
+        because the game is new or the response expired. Returns if it was prewarmed."""
+        account_id = LoL.get_account_id(region, summoner)
+        game_id = LoL.get_latest_match(region, account_id)
+        if cache.RESPONSES.get((region, summoner, game_id)) is not None:
+            return False
+        self.prewarm(region, summoner, game_id)
+        return True
+
+    def spacing(self, region):
+        """Returns the seconds between polls: the watchlist is polled once per interval,
+        but polls never use more than a budget fraction of the region's sustained rate"""
+        configured = ratelimit.parse_limits(config.load_from_env()["APP_RATE_LIMITS"])
+        limits = LoL.RATE_LIMITER.limits.get(region) or configured
+        if not limits:
+            return self.interval / len(self.watchlist)
+        rate = min(float(calls) / seconds for calls, seconds in limits)
+        return max(self.interval / len(self.watchlist), 1 / (self.budget * rate))
+
+    def watch_forever(self):
+        """Polls the watchlist, from a single worker process"""
+        while True:
+            with cache.file_lock(WATCHER_LOCK_FILE, exclusive=True, blocking=False) as leader:
+                if leader:
+                    self.poll_forever()
+            time.sleep(self.interval)
+
+    def poll_forever(self):
+        """Polls each summoner in turn, spacing the polls evenly"""
+        while True:
+            for region, summoner in self.watchlist:
+                start = time.time()
+                try:
+                    if self.poll(region, summoner):
+                        LOGGER.info("Prewarmed the latest game of %s in %s", summoner, region)
+                except Exception:
+                    LOGGER.warning("Could not poll %s in %s", summoner, region, exc_info=True)
+                time.sleep(max(self.spacing(region) - (time.time() - start), 0))
+
+def start_watcher(prewarm):
+    """Starts the background thread polling the WATCHLIST, if there is one"""
+    conf = config.load_from_env()
+    watchlist = parse_watchlist(conf["WATCHLIST"])
+    if not watchlist:
+        return None
+    watcher = Watcher(watchlist, prewarm, conf["WATCHLIST_INTERVAL"], conf["WATCHLIST_BUDGET"])
+    thread = threading.Thread(target=watcher.watch_forever, name="watchlist")
+    thread.daemon = True
+    thread.start()
+    return thread
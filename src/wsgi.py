@@ -0,0 +1,8 @@
+"""Entry point for WSGI servers running the application in several worker processes."""
+import logging
+from app import APP, start_background_tasks
+
+logging.basicConfig(level=logging.INFO)
+start_background_tasks()
+
+application = APP
@@ -1,8 +1,32 @@
 """Unit tests for backend."""
 import unittest
 import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import threading
+import zlib
 import src.app
 import src.LoL
+import src.parallel
+import src.sessions
+import src.ratelimit
+import src.champions
+import src.cache
+import src.refresher
+import src.watchlist
+import src.resilience
+import src.assets
+import src.sharedcache
+import src.singleflight
+import src.async_lol
+import src.matchparser
+import src.matchstore
+import src.metrics
+import mocks.fake_riot
 
 VALID_REGION = "validRegion"
 VALID_SUMMONER_NAME = "validSummoner"
@@ -42,7 +66,7 @@ def mock_get_latest_match(region, account_id):
 def mock_get_match_data(region, match_id):
     """Mocks LoL.get_match_data"""
     if match_id == VALID_MATCH_ID:
-        with open("mocks\\mockmatch.json", "r") as myfile:
+        with open(os.path.join("mocks", "mockmatch.json"), "r") as myfile:
             data = myfile.read()
             return json.loads(data)
     raise src.LoL.ApiError("Match does not exist")
@@ -61,10 +85,11 @@ def mock_get_champion_mastery(region, champion_id, summoner_id):
                  "51" : 5, "222" : 5, "11" : 6, "53" : 6, "92" : 6}
     return masteries[str(champion_id)]
 
-class APITests(unittest.TestCase):
-    """Tests the exposed API."""
+class MockedLoLTestCase(unittest.TestCase):
+    """Replaces the calls to the LoL API with mocks."""
 
     def setUp(self):
+        src.cache.RESPONSES.clear()
         self.old_is_valid_region = src.LoL.is_valid_region
         src.LoL.is_valid_region = mock_is_valid_region
         self.old_get_account_id = src.LoL.get_account_id
@@ -86,6 +111,9 @@ class APITests(unittest.TestCase):
         src.LoL.get_champion_mastery = self.old_get_champion_mastery
         src.LoL.get_champion_name = self.old_get_champion_name
 
+class APITests(MockedLoLTestCase):
+    """Tests the exposed API."""
+
     def test_empty_region(self):
         """Validates if no region returns an error"""
         with self.assertRaises(src.app.APIError) as raised:
@@ -130,11 +158,231 @@ class APITests(unittest.TestCase):
 
     def test_valid_response(self):
         """Validates if good response is as expected (sorted and with correct values)"""
-        with open("mocks\\mockresponse.json", "r") as myfile:
+        with open(os.path.join("mocks", "mockresponse.json"), "r") as myfile:
+            expected_result = myfile.read()
+            obtained_result = src.app.get_game_data(VALID_REGION, VALID_SUMMONER_NAME)
+            self.assertEqual(expected_result, obtained_result)
+
+    def test_response_cached_per_game(self):
+        """Validates if the same latest game is served from cache without lookups"""
+        src.app.get_game_data(VALID_REGION, VALID_SUMMONER_NAME)
+        src.LoL.get_match_data = None
+        src.LoL.get_champion_mastery = None
+        with open(os.path.join("mocks", "mockresponse.json"), "r") as myfile:
             expected_result = myfile.read()
             obtained_result = src.app.get_game_data(VALID_REGION, VALID_SUMMONER_NAME)
             self.assertEqual(expected_result, obtained_result)
 
+    def test_etag_not_modified(self):
+        """Validates if a request with a matching ETag gets a 304 without body"""
+        client = src.app.APP.test_client()
+        query = "/gamedata?region={region}&summoner={summoner}".format(
+            region=VALID_REGION, summoner=VALID_SUMMONER_NAME)
+        first = client.get(query)
+        self.assertEqual(200, first.status_code)
+        etag = first.headers["ETag"]
+        second = client.get(query, headers={"If-None-Match" : etag})
+        self.assertEqual(304, second.status_code)
+        self.assertEqual("", second.data)
+        third = client.get(query, headers={"If-None-Match" : '"other"'})
+        self.assertEqual(200, third.status_code)
+
+    def test_compressed_response(self):
+        """Validates if large responses are gzipped for clients accepting it, with their own ETag"""
+        client = src.app.APP.test_client()
+        query = "/gamedata?region={region}&summoner={summoner}".format(
+            region=VALID_REGION, summoner=VALID_SUMMONER_NAME)
+        plain = client.get(query)
+        self.assertNotIn("Content-Encoding", plain.headers)
+        self.assertIn("Accept-Encoding", plain.headers["Vary"])
+        compressed = client.get(query, headers={"Accept-Encoding" : "gzip, deflate"})
+        self.assertEqual("gzip", compressed.headers["Content-Encoding"])
+        self.assertEqual(plain.data, zlib.decompress(compressed.data, 16 + zlib.MAX_WBITS))
+        self.assertNotEqual(plain.headers["ETag"], compressed.headers["ETag"])
+        not_modified = client.get(query, headers={"Accept-Encoding" : "gzip",
+                                                  "If-None-Match" : compressed.headers["ETag"]})
+        self.assertEqual(304, not_modified.status_code)
+
+    def test_not_modified_not_compressed(self):
+        """Validates if the body of a 304 is not compressed"""
+        client = src.app.APP.test_client()
+        query = "/gamedata?region={region}&summoner={summoner}".format(
+            region=VALID_REGION, summoner=VALID_SUMMONER_NAME)
+        etag = client.get(query, headers={"Accept-Encoding" : "gzip"}).headers["ETag"]
+        old_encode = src.app.assets.encode
+        calls = []
+        def counting_encode(payload, encoding):
+            """Counts the compressed bodies"""
+            calls.append(encoding)
+            return old_encode(payload, encoding)
+        src.app.assets.encode = counting_encode
+        try:
+            not_modified = client.get(query, headers={"Accept-Encoding" : "gzip",
+                                                      "If-None-Match" : etag})
+        finally:
+            src.app.assets.encode = old_encode
+        self.assertEqual(304, not_modified.status_code)
+        self.assertEqual("", not_modified.data)
+        self.assertEqual([], calls)
+
+    def test_compressed_response_from_shared_cache(self):
+        """Validates if a response found in the shared cache of another worker is compressed"""
+        directory = tempfile.mkdtemp()
+        old_responses = src.cache.RESPONSES
+        src.cache.RESPONSES = src.cache.TTLCache(600, 10, shared=src.sharedcache.SharedCache(
+            os.path.join(directory, "shared.sqlite"), "responses", 10))
+        headers = {"Accept-Encoding" : "gzip, deflate, br"}
+        try:
+            client = src.app.APP.test_client()
+            query = "/gamedata?region={region}&summoner={summoner}".format(
+                region=VALID_REGION, summoner=VALID_SUMMONER_NAME)
+            first = client.get(query, headers=headers)
+            src.cache.RESPONSES.entries.clear() #As seen by a worker with a cold memory
+            second = client.get(query, headers=headers)
+        finally:
+            src.cache.RESPONSES = old_responses
+            shutil.rmtree(directory)
+        self.assertEqual(200, second.status_code)
+        self.assertIn(second.headers["Content-Encoding"], ["br", "gzip"])
+        self.assertEqual(decoded_body(first), decoded_body(second))
+
+    def test_small_response_not_compressed(self):
+        """Validates if responses under COMPRESS_MIN_SIZE are sent as they are"""
+        client = src.app.APP.test_client()
+        resp = client.get("/gamedata?region=&summoner=someSummoner",
+                          headers={"Accept-Encoding" : "gzip"})
+        self.assertEqual(400, resp.status_code)
+        self.assertNotIn("Content-Encoding", resp.headers)
+
+class StreamAPITests(MockedLoLTestCase):
+    """Tests the streaming endpoint."""
+
+    def get_events(self, summoner):
+        """Gets the events streamed for a summoner"""
+        client = src.app.APP.test_client()
+        query = "/gamedata/stream?region={region}&summoner={summoner}".format(
+            region=VALID_REGION, summoner=summoner)
+        resp = client.get(query)
+        return resp, [json.loads(line) for line in resp.data.splitlines()]
+
+    def test_events_in_order(self):
+        """Validates if the header comes first, then each participant, then the result"""
+        resp, events = self.get_events(VALID_SUMMONER_NAME)
+        self.assertEqual("application/x-ndjson", resp.mimetype)
+        self.assertEqual(["header"] + ["participant"] * 10 + ["complete"],
+                         [event["type"] for event in events])
+        self.assertEqual(VALID_MATCH_ID, events[0]["gameId"])
+        with open(os.path.join("mocks", "mockresponse.json"), "r") as myfile:
+            self.assertEqual(json.loads(myfile.read()), events[-1]["data"])
+
+    def test_cached_events(self):
+        """Validates if a cached game streams the same events"""
+        first_events = self.get_events(VALID_SUMMONER_NAME)[1]
+        src.LoL.get_champion_mastery = None
+        second_events = self.get_events(VALID_SUMMONER_NAME)[1]
+        self.assertEqual(first_events[-1], second_events[-1])
+        self.assertEqual(len(first_events), len(second_events))
+
+    def test_cached_game_not_modified(self):
+        """Validates if revalidating a resolved game gets a 304, while a new one has no ETag"""
+        first = self.get_events(VALID_SUMMONER_NAME)[0]
+        self.assertNotIn("ETag", first.headers)
+        second = self.get_events(VALID_SUMMONER_NAME)[0]
+        client = src.app.APP.test_client()
+        query = "/gamedata/stream?region={region}&summoner={summoner}".format(
+            region=VALID_REGION, summoner=VALID_SUMMONER_NAME)
+        third = client.get(query, headers={"If-None-Match" : second.headers["ETag"]})
+        self.assertEqual(304, third.status_code)
+        self.assertEqual("", third.data)
+        gamedata = client.get(query.replace("/stream", ""))
+        self.assertNotEqual(gamedata.headers["ETag"], second.headers["ETag"])
+
+    def test_error_before_header(self):
+        """Validates if an error before the game is known returns an error status"""
+        resp = self.get_events("invalidSummoner")[0]
+        self.assertEqual(404, resp.status_code)
+
+    def test_error_after_header(self):
+        """Validates if a failed participant lookup is streamed as an error event"""
+        def failing_get_champion_mastery(region, champion_id, summoner_id):
+            """Fails for a single champion"""
+            if champion_id == 92:
+                raise src.LoL.ApiError("Mastery failed")
+            return mock_get_champion_mastery(region, champion_id, summoner_id)
+        src.LoL.get_champion_mastery = failing_get_champion_mastery
+        events = self.get_events(VALID_SUMMONER_NAME)[1]
+        self.assertEqual("header", events[0]["type"])
+        self.assertEqual("error", events[-1]["type"])
+        self.assertEqual(500, events[-1]["error"]["status"]["status_code"])
+
+class BatchAPITests(MockedLoLTestCase):
+    """Tests the batch endpoint."""
+
+    def post_batch(self, body):
+        """Posts a body to the batch endpoint"""
+        client = src.app.APP.test_client()
+        return client.post("/gamedata/batch", data=json.dumps(body),
+                           content_type="application/json")
+
+    def test_results_and_errors_per_entry(self):
+        """Validates if every entry gets its own result or error, in order"""
+        summoners = [{"region" : VALID_REGION, "summoner" : VALID_SUMMONER_NAME},
+                     {"region" : VALID_REGION, "summoner" : "invalidSummoner"},
+                     {"region" : "invalidRegion", "summoner" : VALID_SUMMONER_NAME}]
+        resp = self.post_batch({"summoners" : summoners})
+        self.assertEqual(200, resp.status_code)
+        results = json.loads(resp.data)["results"]
+        self.assertEqual([200, 404, 404], [result["status"] for result in results])
+        with open(os.path.join("mocks", "mockresponse.json"), "r") as myfile:
+            self.assertEqual(json.loads(myfile.read()), results[0]["data"])
+        self.assertIn("invalidSummoner does not exist", results[1]["error"]["status"]["message"])
+        self.assertEqual("invalidRegion", results[2]["region"])
+
+    def test_repeated_entries_resolved_once(self):
+        """Validates if the same summoner requested twice is only resolved once"""
+        calls = []
+        def counting_get_account_id(region, summoner_name):
+            """Counts the account lookups"""
+            calls.append(summoner_name)
+            return mock_get_account_id(region, summoner_name)
+        src.LoL.get_account_id = counting_get_account_id
+        summoners = [{"region" : VALID_REGION, "summoner" : VALID_SUMMONER_NAME}] * 3
+        results = json.loads(self.post_batch({"summoners" : summoners}).data)["results"]
+        self.assertEqual(3, len(results))
+        self.assertEqual(1, len(calls))
+
+    def test_invalid_body(self):
+        """Validates if a body without a list of summoners returns an error"""
+        self.assertEqual(400, self.post_batch({"summoner" : "someone"}).status_code)
+        self.assertEqual(400, self.post_batch({"summoners" : ["someone"]}).status_code)
+
+    def test_invalid_entry_values(self):
+        """Validates if a region or summoner that is not a string returns an error"""
+        for entry in [{"region" : [VALID_REGION], "summoner" : VALID_SUMMONER_NAME},
+                      {"region" : VALID_REGION, "summoner" : {"name" : VALID_SUMMONER_NAME}},
+                      {"region" : VALID_REGION, "summoner" : 1}]:
+            resp = self.post_batch({"summoners" : [entry]})
+            self.assertEqual(400, resp.status_code)
+            self.assertIn("'summoners'", json.loads(resp.data)["status"]["message"])
+
+    def test_too_many_summoners(self):
+        """Validates if more summoners than allowed returns an error"""
+        summoners = [{"region" : VALID_REGION, "summoner" : str(i)} for i in range(51)]
+        self.assertEqual(400, self.post_batch({"summoners" : summoners}).status_code)
+
+class AsyncAPITests(MockedLoLTestCase):
+    """Tests the calls run in the background by the asynchronous client."""
+
+    def test_as_completed_fails_fast(self):
+        """Validates if a failed call is raised without waiting for slower ones"""
+        release = threading.Event()
+        slow = src.async_lol.submit(VALID_REGION, release.wait, 1)
+        failed = src.async_lol.submit(VALID_REGION, src.LoL.get_account_id, VALID_REGION,
+                                      "invalidSummoner")
+        with self.assertRaises(src.LoL.SummonerNotFoundError):
+            list(src.async_lol.as_completed([slow, failed], 5))
+        release.set()
+
 CHAMPION_ID_FRESH = 11111
 CHAMPION_ID_NONCACHE = 22222
 CHAMPION_NAME_FRESH = "Fresh"
@@ -160,7 +408,7 @@ def mock_get_base_url(region):
     """Mocks LoL.get_base_url"""
     return region + ".com"
 
-def mock_requests_get(url, params):
+def mock_requests_get(url, params, stream=False, read_timeout=None):
     """Mocks requests.get"""
     if CHAMPION_ID_FRESH in url:
         payload = CHAMPION_NAME_FRESH_NO_CACHE
@@ -209,12 +457,1058 @@ class CacheTests(unittest.TestCase):
         name = src.LoL.get_champion_name("", CHAMPION_ID_NONCACHE)
         self.assertEqual(CHAMPION_NAME_NONCACHE, name)
 
+def slow_identity(value):
+    """Returns the value after sleeping a time inversely proportional to it"""
+    time.sleep(0.01 * (5 - value))
+    return value
+
+SLOW_LOOKUPS_RELEASED = threading.Event()
+
+def fail_on_last(value):
+    """Fails immediately for the last value and blocks the others until released"""
+    if value == 4:
+        raise src.LoL.ApiError("Lookup failed")
+    SLOW_LOOKUPS_RELEASED.wait(1)
+    return value
+
+def decoded_body(resp):
+    """Returns the body of a response, decompressed according to its 'Content-Encoding'"""
+    encoding = resp.headers.get("Content-Encoding")
+    if encoding == "br":
+        return src.assets.brotli.decompress(resp.data)
+    if encoding == "gzip":
+        return zlib.decompress(resp.data, 16 + zlib.MAX_WBITS)
+    return resp.data
+
+FAKE_BASE_URL = "http://fakeriot/{queryRegion}/lol"
+
+def wait_for_refreshes():
+    """Waits until the background refreshes of stale cache entries are done"""
+    deadline = time.time() + 1
+    while src.refresher.pending() > 0 and time.time() < deadline:
+        time.sleep(0.001)
+
+class FakeRiotTests(unittest.TestCase):
+    """Tests the LoL.py methods against the fake LoL API"""
+
+    def setUp(self):
+        self.fake = mocks.fake_riot.FakeRiot(seed=1)
+        self.directory = tempfile.mkdtemp()
+        self.old_environ = dict(os.environ)
+        os.environ["API_BASE_URL"] = FAKE_BASE_URL
+        os.environ["API_KEY"] = "LoremIpsum"
+        self.old_request_get = src.LoL.request_get
+        src.LoL.request_get = self.fake.request_get
+        self.old_rate_limiter = src.LoL.RATE_LIMITER
+        src.LoL.RATE_LIMITER = src.ratelimit.RateLimiter()
+        self.old_match_store = src.matchstore.MATCHES
+        src.matchstore.MATCHES = src.matchstore.MatchStore(self.directory, 10 ** 6)
+        self.old_champions = src.cache.CHAMPIONS
+        src.cache.CHAMPIONS = {}
+        self.old_champions_store = src.cache.CHAMPIONS_STORE
+        src.cache.CHAMPIONS_STORE = src.cache.AppendOnlyStore(
+            os.path.join(self.directory, "champions.jsonl"))
+        for ttl_cache in [src.cache.ACCOUNTS, src.cache.MATCHES, src.cache.MASTERIES,
+                          src.cache.RESPONSES]:
+            ttl_cache.clear()
+        src.cache.NEGATIVES.clear()
+        src.resilience.reset()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        src.LoL.request_get = self.old_request_get
+        src.LoL.RATE_LIMITER = self.old_rate_limiter
+        src.matchstore.MATCHES = self.old_match_store
+        src.cache.CHAMPIONS = self.old_champions
+        src.cache.CHAMPIONS_STORE = self.old_champions_store
+        shutil.rmtree(self.directory)
+
+    def test_account_id(self):
+        """Tests that the account of an existing summoner is returned"""
+        self.assertEqual(26680615, src.LoL.get_account_id("EUW", "G3orgbastard"))
+
+    def test_summoner_not_found(self):
+        """Tests that a 404 raises SummonerNotFoundError"""
+        with self.assertRaises(src.LoL.SummonerNotFoundError):
+            src.LoL.get_account_id("EUW", "missingSummoner")
+
+    def test_missing_results_cached(self):
+        """Tests that missing summoners, matchlists and matches are not requested twice"""
+        for _ in range(2):
+            with self.assertRaises(src.app.APIError) as raised:
+                src.app.get_game_data("EUW", "missingSummoner")
+            self.assertEqual(404, raised.exception.status_code)
+            with self.assertRaises(src.app.APIError) as raised:
+                src.app.get_game_data("EUW", "nogamesSummoner")
+            self.assertEqual(404, raised.exception.status_code)
+            with self.assertRaises(src.LoL.RequestError):
+                src.LoL.get_match_data("EUW", INVALID_MATCH_ID)
+        self.assertEqual(2, self.fake.calls["summoner"])
+        self.assertEqual(1, self.fake.calls["matchlist"])
+        self.assertEqual(1, self.fake.calls["match"])
+
+    def test_missing_results_cached_per_region(self):
+        """Tests that a region's missing summoners don't evict the other regions'"""
+        old_max_entries = src.cache.NEGATIVES.max_entries
+        src.cache.NEGATIVES.max_entries = 1
+        try:
+            for region, summoner in [("EUW", "missingSummoner"), ("NA", "missingOne"),
+                                     ("NA", "missingTwo"), ("EUW", "missingSummoner")]:
+                with self.assertRaises(src.LoL.SummonerNotFoundError):
+                    src.LoL.get_account_id(region, summoner)
+        finally:
+            src.cache.NEGATIVES.max_entries = old_max_entries
+        self.assertEqual(3, self.fake.calls["summoner"])
+
+    def test_watchlist_prewarms_new_games(self):
+        """Tests that a watched summoner's new game is served without match or mastery calls"""
+        watcher = src.watchlist.Watcher([("EUW", "G3orgbastard")], src.app.game_response, 60, 1)
+        self.assertTrue(watcher.poll("EUW", "G3orgbastard"))
+        self.assertFalse(watcher.poll("EUW", "G3orgbastard"))
+        src.cache.RESPONSES.clear() #Expired while the summoner doesn't play
+        self.assertTrue(watcher.poll("EUW", "G3orgbastard"))
+        calls = dict(self.fake.calls)
+        game_data = json.loads(src.app.get_game_data("EUW", "G3orgbastard"))
+        self.assertEqual(VALID_MATCH_ID, game_data["gameId"])
+        self.assertEqual(calls["matchlist"] + 1, self.fake.calls["matchlist"])
+        self.assertEqual(calls["match"], self.fake.calls["match"])
+        self.assertEqual(calls["mastery"], self.fake.calls["mastery"])
+
+    def test_latest_match(self):
+        """Tests that the latest match of an account is returned"""
+        self.assertEqual(VALID_MATCH_ID, src.LoL.get_latest_match("EUW", 26680615))
+
+    def test_latest_match_newest_entry_only(self):
+        """Tests that the matchlist is requested for its newest entry only"""
+        calls = []
+        def recording_request_get(url, params, stream=False, read_timeout=None):
+            """Records the parameters of the call"""
+            calls.append(params)
+            return self.fake.request_get(url, params, stream, read_timeout)
+        src.LoL.request_get = recording_request_get
+        self.assertEqual(VALID_MATCH_ID, src.LoL.get_latest_match("EUW", 26680615))
+        self.assertEqual(0, calls[0]["beginIndex"])
+        self.assertEqual(1, calls[0]["endIndex"])
+
+    def test_account_cached(self):
+        """Tests that a summoner's account is only requested once"""
+        for _ in range(2):
+            self.assertEqual(26680615, src.LoL.get_account_id("EUW", "G3orgbastard"))
+        self.assertEqual(1, self.fake.calls["summoner"])
+
+    def test_no_matches(self):
+        """Tests that a 422 raises NoMatchesError"""
+        account_id = src.LoL.get_account_id("EUW", "nogamesSummoner")
+        with self.assertRaises(src.LoL.NoMatchesError):
+            src.LoL.get_latest_match("EUW", account_id)
+
+    def test_match_data(self):
+        """Tests that the match is parsed and kept in memory and on disk"""
+        match = src.LoL.get_match_data("EUW", VALID_MATCH_ID)
+        self.assertEqual(VALID_MATCH_ID, match["gameId"])
+        self.assertEqual(10, len(match["participants"]))
+        self.assertEqual(match, src.matchstore.MATCHES.get("EUW", VALID_MATCH_ID))
+        src.LoL.get_match_data("EUW", VALID_MATCH_ID)
+        self.assertEqual(1, self.fake.calls["match"])
+
+    def test_invalid_match(self):
+        """Tests that a 404 for a match raises RequestError"""
+        with self.assertRaises(src.LoL.RequestError):
+            src.LoL.get_match_data("EUW", INVALID_MATCH_ID)
+
+    def test_champion_name_and_list(self):
+        """Tests that champion names are fetched one by one or all at once"""
+        self.assertEqual("Riven", src.LoL.get_champion_name("EUW", 92))
+        self.assertEqual("Riven", src.cache.get_champion_name(92))
+        self.assertEqual("Poppy", src.LoL.get_champion_list("EUW")["78"])
+
+    def test_stale_champion_refreshed_in_background(self):
+        """Tests that an expired champion name is served and then refreshed"""
+        src.cache.CHAMPIONS["92"] = {"name" : "Old Riven", "time" : 0L}
+        self.assertEqual("Old Riven", src.LoL.get_champion_name("EUW", 92))
+        wait_for_refreshes()
+        self.assertEqual(1, self.fake.calls["champion"])
+        self.assertEqual("Riven", src.LoL.get_champion_name("EUW", 92))
+        self.assertFalse(src.cache.champion_name_stale(92))
+
+    def test_champion_mastery(self):
+        """Tests that the mastery level is returned"""
+        self.assertEqual(6, src.LoL.get_champion_mastery("EUW", 92, 48629218))
+
+    def test_server_error(self):
+        """Tests that a 5xx raises ApiError"""
+        self.fake.errors = {"mastery" : {503 : 1.0}}
+        with self.assertRaises(src.LoL.ApiError):
+            src.LoL.get_champion_mastery("EUW", 92, 48629218)
+
+    def test_unreachable_api_hides_key(self):
+        """Tests that the error of an unreachable API doesn't reveal the API key"""
+        src.LoL.request_get = self.old_request_get
+        os.environ["API_BASE_URL"] = "http://127.0.0.1:1/{queryRegion}/lol"
+        os.environ["API_KEY"] = "SECRET-KEY-123"
+        client = src.app.APP.test_client()
+        resp = client.get("/gamedata?region=EUW&summoner=abc")
+        self.assertEqual(500, resp.status_code)
+        self.assertIn("Could not reach the LoL API", resp.data)
+        self.assertNotIn("SECRET-KEY-123", resp.data)
+
+    def test_rate_limited(self):
+        """Tests that going over the rate limit of the API raises RateLimitError"""
+        self.fake.app_rate_limit = "1:10"
+        os.environ["RATE_LIMIT_MAX_WAIT"] = "0.5"
+        src.LoL.get_account_id("EUW", "G3orgbastard")
+        with self.assertRaises(src.LoL.RateLimitError):
+            src.LoL.get_account_id("EUW", "H4uZ")
+        self.assertEqual([(1, 10)], src.LoL.RATE_LIMITER.limits["EUW"])
+
+    def test_metrics(self):
+        """Tests that upstream calls and cache lookups are exposed as metrics"""
+        src.LoL.get_champion_mastery("EUW", 92, 48629218)
+        src.LoL.get_champion_mastery("EUW", 92, 48629218)
+        rendered = src.app.APP.test_client().get("/metrics").data
+        self.assertIn('lol_api_request_duration_seconds_count{region="EUW",'
+                      'method="/champion-mastery/v3/champion-masteries/by-summoner/'
+                      '{summonerid}/by-champion/{championid}",status="200"}', rendered)
+        self.assertIn('cache_hits_total{cache="masteries"}', rendered)
+        self.assertIn('lol_api_requests_in_flight{region="EUW"} 0.0', rendered)
+
+    def test_trace(self):
+        """Tests that the phases of a request are logged when tracing"""
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        src.metrics.LOGGER.addHandler(handler)
+        src.metrics.LOGGER.setLevel(logging.INFO)
+        os.environ["TRACE_REQUESTS"] = "1"
+        try:
+            src.app.get_game_data("EUW", "G3orgbastard")
+        finally:
+            src.metrics.LOGGER.removeHandler(handler)
+            src.metrics.LOGGER.setLevel(logging.NOTSET)
+        self.assertEqual(1, len(messages))
+        for phase in ["account=", "matchlist=", "match=", "participants=", "serialize="]:
+            self.assertIn(phase, messages[0])
+
+    def test_game_data(self):
+        """Tests the whole API against the fake LoL API"""
+        with open(os.path.join("mocks", "mockresponse.json"), "r") as myfile:
+            expected_result = myfile.read()
+        self.assertEqual(expected_result, src.app.get_game_data("EUW", "G3orgbastard"))
+        self.assertEqual(1 + 1 + 1 + 10 + 10, self.fake.total_calls())
+
+class MetricsTests(unittest.TestCase):
+    """Tests the rendering of metrics"""
+
+    def test_counter(self):
+        """Tests that counters are rendered with their labels"""
+        registry = src.metrics.Registry()
+        counter = registry.register(src.metrics.Counter("calls_total", "Calls.", ("region",)))
+        counter.inc(1, "EUW")
+        counter.inc(2, "EUW")
+        self.assertEqual('# HELP calls_total Calls.\n# TYPE calls_total counter\n'
+                         'calls_total{region="EUW"} 3.0\n', registry.render())
+
+    def test_histogram(self):
+        """Tests that histograms are rendered with cumulative buckets, count and sum"""
+        registry = src.metrics.Registry()
+        histogram = registry.register(src.metrics.Histogram("duration_seconds", "Duration.",
+                                                            buckets=(0.1, 1)))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        lines = registry.render().splitlines()
+        self.assertEqual(['duration_seconds_bucket{le="0.1"} 1.0',
+                          'duration_seconds_bucket{le="1.0"} 2.0',
+                          'duration_seconds_bucket{le="+Inf"} 2.0',
+                          'duration_seconds_count 2.0',
+                          'duration_seconds_sum 0.55'], lines[2:])
+
+    def test_shared_between_workers(self):
+        """Tests that counters are summed over the workers, even after they exit,
+        and gauges are rendered per live worker"""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "shared.sqlite")
+            for worker, calls in [("first", 3), ("second", 2)]:
+                counter = src.metrics.Counter("calls_total", "Calls.", ("region",))
+                counter.inc(calls, "EUW")
+                gauge = src.metrics.Gauge("in_flight", "In flight.")
+                gauge.set(calls)
+                src.metrics.SharedSamples(path, worker).publish([counter, gauge])
+            shared = src.metrics.SharedSamples(path, "second")
+            lines = src.metrics.render(shared.combined()).splitlines()
+            self.assertIn('calls_total{region="EUW"} 5.0', lines)
+            self.assertIn('in_flight{worker="first"} 3.0', lines)
+            self.assertIn('in_flight{worker="second"} 2.0', lines)
+
+            shared.database().execute("UPDATE metric_samples SET updated = 0 "
+                                      "WHERE worker = 'first'") #Exited long ago
+            for _ in range(2):
+                lines = src.metrics.render(shared.combined()).splitlines()
+                self.assertIn('calls_total{region="EUW"} 5.0', lines)
+                self.assertNotIn('in_flight{worker="first"} 3.0', lines)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_no_trace_by_default(self):
+        """Tests that phases are not measured when not tracing"""
+        self.assertIs(src.metrics.NULL_PHASE, src.metrics.phase("account"))
+
+class ParallelTests(unittest.TestCase):
+    """Tests the concurrent lookups"""
+
+    def test_results_keep_input_order(self):
+        """Tests that results come back in input order regardless of completion order"""
+        results = src.parallel.map_ordered(slow_identity, range(5), 5)
+        self.assertEqual(range(5), results)
+
+    def test_first_error_fails_fast(self):
+        """Tests that a failed lookup is raised without waiting for slower ones"""
+        start = time.time()
+        with self.assertRaises(src.LoL.ApiError):
+            src.parallel.map_ordered(fail_on_last, range(5), 5)
+        self.assertLess(time.time() - start, 0.5)
+        SLOW_LOOKUPS_RELEASED.set()
+
+    def test_timeout(self):
+        """Tests that lookups taking longer than the timeout raise an error"""
+        with self.assertRaises(src.parallel.LookupTimeoutError):
+            src.parallel.map_ordered(slow_identity, range(5), 0.01)
+
+    def test_failure_skips_queued_lookups(self):
+        """Tests that lookups still queued when a lookup fails are not run"""
+        calls = []
+        def fail_first(value):
+            """Fails for the first value and is slow for the others"""
+            calls.append(value)
+            if value == 0:
+                raise src.LoL.ApiError("Lookup failed")
+            time.sleep(0.05)
+            return value
+        with self.assertRaises(src.LoL.ApiError):
+            src.parallel.map_ordered(fail_first, range(40), 5, "cancelledRegion")
+        time.sleep(0.3)
+        self.assertLess(len(calls), 20)
+
+    def test_pool_per_region(self):
+        """Tests that calls of a busy region don't queue the calls of another one"""
+        release = threading.Event()
+        pool = src.parallel.RegionPool(3, 2)
+        calls = []
+        for _ in range(3):
+            pool.apply_async("busyRegion", release.wait, (5,))
+        pool.apply_async(VALID_REGION, calls.append, (VALID_REGION,))
+        try:
+            deadline = time.time() + 1
+            while not calls and time.time() < deadline:
+                time.sleep(0.001)
+            self.assertEqual([VALID_REGION], calls)
+            self.assertEqual(2, pool.active["busyRegion"])
+            self.assertEqual(1, len(pool.queued["busyRegion"]))
+        finally:
+            release.set()
+
+class ChampionStoreTests(unittest.TestCase):
+    """Tests the append-only persistence of the champions cache"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "champions.jsonl")
+        self.store = src.cache.AppendOnlyStore(self.path, compact_min=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_latest_record_wins(self):
+        """Tests that appended records are loaded back with the latest value per key"""
+        self.store.append([{"id" : "4", "name" : "Old"}, {"id" : "78", "name" : "Poppy"}])
+        self.store.append([{"id" : "4", "name" : "Twisted Fate"}])
+        records = src.cache.AppendOnlyStore(self.path).load()
+        self.assertEqual("Twisted Fate", records["4"]["name"])
+        self.assertEqual("Poppy", records["78"]["name"])
+
+    def test_truncated_line_is_skipped(self):
+        """Tests that a write interrupted by a crash doesn't lose the other records"""
+        self.store.append([{"id" : "4", "name" : "Twisted Fate"}])
+        with open(self.path, "ab") as store:
+            store.write('{"id" : "78", "na')
+        records = src.cache.AppendOnlyStore(self.path).load()
+        self.assertEqual(["4"], records.keys())
+
+    def test_compaction_drops_superseded_records(self):
+        """Tests that compaction keeps one line per record"""
+        for name in ["First", "Second", "Third"]:
+            self.store.append([{"id" : "4", "name" : name}])
+        self.store.refresh()
+        self.assertTrue(self.store.needs_compaction(1))
+        self.assertTrue(self.store.compact())
+        self.store.append([{"id" : "78", "name" : "Poppy"}])
+        with open(self.path, "rb") as store:
+            self.assertEqual(2, len(store.readlines()))
+        records = src.cache.AppendOnlyStore(self.path).load()
+        self.assertEqual("Third", records["4"]["name"])
+        self.assertEqual(2, len(records))
+
+    def test_refresh_reads_other_appends(self):
+        """Tests that records appended by another process are picked up"""
+        other = src.cache.AppendOnlyStore(self.path)
+        self.store.append([{"id" : "4", "name" : "Twisted Fate"}])
+        self.assertEqual(["4"], self.store.load().keys())
+        other.append([{"id" : "78", "name" : "Poppy"}])
+        self.assertEqual(["78"], self.store.refresh().keys())
+        self.assertEqual({}, self.store.refresh())
+
+    def test_refresh_after_compaction(self):
+        """Tests that a store reads the whole file again once another process compacted it"""
+        other = src.cache.AppendOnlyStore(self.path, compact_min=0)
+        self.store.append([{"id" : "4", "name" : "Old"}, {"id" : "4", "name" : "New"}])
+        self.store.load()
+        other.compact()
+        self.store.append([{"id" : "78", "name" : "Poppy"}])
+        records = self.store.refresh()
+        self.assertEqual("New", records["4"]["name"])
+        self.assertIn("78", records)
+
+class MatchParserTests(unittest.TestCase):
+    """Tests the selective parsing of match payloads"""
+
+    def parse_in_chunks(self, raw, spec, size):
+        """Parses raw JSON split in chunks of the given size"""
+        chunks = [raw[i:i + size] for i in range(0, len(raw), size)]
+        return src.matchparser.StreamParser(chunks).parse(spec)
+
+    def test_match_fields(self):
+        """Tests that only the needed fields of the mock match are kept, whatever the chunks"""
+        with open(os.path.join("mocks", "mockmatch.json"), "r") as myfile:
+            raw = myfile.read()
+        full = json.loads(raw)
+        for size in [1, 100, len(raw)]:
+            match = self.parse_in_chunks(raw, src.matchparser.MATCH_FIELDS, size)
+            self.assertEqual(full["gameId"], match["gameId"])
+            self.assertEqual(["participantId", "player"], sorted(match["participantIdentities"][0]))
+            self.assertEqual(full["participantIdentities"][9]["player"]["summonerName"],
+                             match["participantIdentities"][9]["player"]["summonerName"])
+            self.assertEqual([{"participantId" : p["participantId"], "teamId" : p["teamId"],
+                               "championId" : p["championId"]} for p in full["participants"]],
+                             match["participants"])
+
+    def test_skipped_strings_with_brackets(self):
+        """Tests that brackets and escaped quotes inside skipped strings are ignored"""
+        raw = '{"skip": ["}\\"]", {"a": "{"}], "keep": {"name": "x\\"y"}, "n": -1.5e3}'
+        result = self.parse_in_chunks(raw, {"keep" : True, "n" : True}, 3)
+        self.assertEqual({"keep" : {"name" : 'x"y'}, "n" : -1500.0}, result)
+
+    def test_truncated_payload(self):
+        """Tests that a payload cut short raises an error"""
+        with self.assertRaises(ValueError):
+            self.parse_in_chunks('{"gameId": 1, "participants": [{"te', {"gameId" : True}, 4)
+
+class MatchStoreTests(unittest.TestCase):
+    """Tests the persistence of matches on disk"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = src.matchstore.MatchStore(self.directory, 10 ** 6)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_stored_match(self):
+        """Tests that a stored match is read back, also by another store"""
+        match = {"gameId" : 1, "participants" : [{"participantId" : 1, "teamId" : 100}]}
+        self.store.put("EUW", 1, match)
+        self.assertEqual(match, self.store.get("EUW", 1))
+        other_store = src.matchstore.MatchStore(self.directory, 10 ** 6)
+        self.assertEqual(match, other_store.get("EUW", 1))
+        self.assertIsNone(self.store.get("NA", 1))
+
+    def test_corrupt_file(self):
+        """Tests that an unreadable file is a miss"""
+        self.store.put("EUW", 1, {"gameId" : 1})
+        with open(self.store.path("EUW", 1), "wb") as stored:
+            stored.write("not compressed")
+        self.assertIsNone(self.store.get("EUW", 1))
+        self.assertFalse(os.path.exists(self.store.path("EUW", 1)))
+
+    def test_oldest_evicted(self):
+        """Tests that the oldest matches are removed when over the size cap"""
+        match = {"gameId" : 1, "names" : [str(i) * 10 for i in range(100)]}
+        self.store.put("EUW", 1, match)
+        self.store.evictor.join()
+        size = os.path.getsize(self.store.path("EUW", 1))
+        os.utime(self.store.path("EUW", 1), (0, 0))
+        self.store.max_bytes = size * 2
+        self.store.put("EUW", 2, match)
+        self.store.put("EUW", 3, match)
+        self.store.evictor.join()
+        self.assertIsNone(self.store.get("EUW", 1))
+        self.assertEqual(match, self.store.get("EUW", 3))
+
+    def test_store_failure_ignored(self):
+        """Tests that a match which can't be written is not an error"""
+        with open(os.path.join(self.directory, "EUW"), "wb") as blocking_file:
+            blocking_file.write("not a directory")
+        self.store.put("EUW", 1, {"gameId" : 1})
+        self.assertIsNone(self.store.get("EUW", 1))
+
+class TTLCacheTests(unittest.TestCase):
+    """Tests the bounded in-memory caches"""
+
+    def test_hit_and_miss(self):
+        """Tests that stored values are returned and counted"""
+        ttl_cache = src.cache.TTLCache(60, 10)
+        ttl_cache.set("key", 1)
+        self.assertEqual(1, ttl_cache.get("key"))
+        self.assertIsNone(ttl_cache.get("other"))
+        self.assertEqual(1, ttl_cache.stats()["hits"])
+        self.assertEqual(1, ttl_cache.stats()["misses"])
+
+    def test_expired_value(self):
+        """Tests that values older than the ttl are not returned"""
+        ttl_cache = src.cache.TTLCache(-1, 10)
+        ttl_cache.set("key", 1)
+        self.assertIsNone(ttl_cache.get("key"))
+
+    def test_least_recently_used_evicted(self):
+        """Tests that the least recently used value is evicted when full"""
+        ttl_cache = src.cache.TTLCache(None, 2)
+        ttl_cache.set("first", 1)
+        ttl_cache.set("second", 2)
+        ttl_cache.get("first")
+        ttl_cache.set("third", 3)
+        self.assertIsNone(ttl_cache.get("second"))
+        self.assertEqual(1, ttl_cache.get("first"))
+        self.assertEqual(1, ttl_cache.stats()["evictions"])
+
+    def test_stale_value(self):
+        """Tests that expired values are returned as stale during stale_ttl"""
+        ttl_cache = src.cache.TTLCache(-1, 10, stale_ttl=60)
+        ttl_cache.set("key", 1)
+        self.assertEqual((1, True), ttl_cache.lookup("key"))
+        self.assertEqual(1, ttl_cache.stats()["stale_hits"])
+        ttl_cache = src.cache.TTLCache(-1, 10, stale_ttl=0.5)
+        ttl_cache.set("key", 1)
+        self.assertEqual((None, False), ttl_cache.lookup("key"))
+
+    def test_expiry_jitter(self):
+        """Tests that ttls are shortened by a stable amount per key, within the jitter"""
+        ttls = set(src.cache.jittered(1000, key) for key in range(20))
+        self.assertGreater(len(ttls), 1)
+        self.assertTrue(all(900 <= ttl <= 1000 for ttl in ttls))
+        self.assertEqual(src.cache.jittered(1000, "key"), src.cache.jittered(1000, "key"))
+
+    def test_refreshes_bounded(self):
+        """Tests that refreshes are not repeated for a key and dropped over the bound"""
+        released = threading.Event()
+        old_environ = dict(os.environ)
+        os.environ["REFRESH_MAX_PENDING"] = "2"
+        try:
+            self.assertTrue(src.refresher.schedule("first", released.wait, 1))
+            self.assertFalse(src.refresher.schedule("first", released.wait, 1))
+            self.assertTrue(src.refresher.schedule("second", released.wait, 1))
+            self.assertFalse(src.refresher.schedule("third", released.wait, 1))
+        finally:
+            os.environ.clear()
+            os.environ.update(old_environ)
+            released.set()
+        wait_for_refreshes()
+        self.assertEqual(0, src.refresher.pending())
+
+    def test_memory_bound(self):
+        """Tests that values are evicted when over the memory bound"""
+        ttl_cache = src.cache.TTLCache(None, 100, 1000)
+        for key in range(10):
+            ttl_cache.set(key, "x" * 400)
+        self.assertLessEqual(ttl_cache.stats()["bytes"], 1000)
+        self.assertIsNone(ttl_cache.get(0))
+        self.assertIsNotNone(ttl_cache.get(9))
+
+class SharedCacheTests(unittest.TestCase):
+    """Tests the cache shared between worker processes"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "shared.sqlite")
+        self.old_interval = src.cache.GENERATION_CHECK_INTERVAL
+        src.cache.GENERATION_CHECK_INTERVAL = 0
+
+    def tearDown(self):
+        src.cache.GENERATION_CHECK_INTERVAL = self.old_interval
+        shutil.rmtree(self.directory)
+
+    def shared(self):
+        """Opens the shared table like a separate process would"""
+        return src.sharedcache.SharedCache(self.path, "accounts", 10)
+
+    def test_value_shared(self):
+        """Tests that a value stored by one worker is found by another"""
+        first = src.cache.TTLCache(60, 10, shared=self.shared())
+        second = src.cache.TTLCache(60, 10, shared=self.shared())
+        first.set(("EUW", "someSummoner"), {"accountId" : 7})
+        self.assertEqual({"accountId" : 7}, second.get(("EUW", "someSummoner")))
+        self.assertEqual(1, second.stats()["shared_hits"])
+
+    def test_expired_value(self):
+        """Tests that expired shared values are not returned"""
+        shared = self.shared()
+        shared.set("key", 1, -1)
+        self.assertIsNone(shared.get_entry("key"))
+
+    def test_purge_bounds_entries(self):
+        """Tests that purging keeps at most max_entries values"""
+        shared = self.shared()
+        for key in range(15):
+            shared.set(key, key, None)
+        shared.purge()
+        self.assertIsNone(shared.get_entry(0))
+        self.assertEqual((14, None), shared.get_entry(14))
+
+    def test_locked_database_is_a_miss(self):
+        """Tests that a database locked by another process doesn't fail nor block lookups"""
+        ttl_cache = src.cache.TTLCache(60, 10, shared=self.shared())
+        locker = sqlite3.connect(self.path, isolation_level=None)
+        locker.execute("BEGIN EXCLUSIVE")
+        try:
+            start = time.time()
+            ttl_cache.set("key", 1)
+            ttl_cache.invalidate("other")
+            self.assertLess(time.time() - start, 1)
+            self.assertEqual(1, ttl_cache.get("key"))
+        finally:
+            locker.execute("ROLLBACK")
+            locker.close()
+        self.assertIsNone(self.shared().get_entry("key"))
+
+    def test_invalidation_reaches_other_workers(self):
+        """Tests that invalidating a key drops the copies in other workers' memory"""
+        first = src.cache.TTLCache(60, 10, shared=self.shared())
+        second = src.cache.TTLCache(60, 10, shared=self.shared())
+        first.set("key", 1)
+        self.assertEqual(1, second.get("key"))
+        first.invalidate("key")
+        self.assertIsNone(second.get("key"))
+
+class WatchlistTests(unittest.TestCase):
+    """Tests the configuration and pacing of the watchlist"""
+
+    def test_parse_watchlist(self):
+        """Tests that entries without a region are ignored"""
+        self.assertEqual([("EUW", "some Summoner"), ("NA", "other")],
+                         src.watchlist.parse_watchlist("euw:some Summoner, NA:other,nobody"))
+
+    def test_spacing_within_budget(self):
+        """Tests that polls are spaced to use at most the budget of the sustained rate"""
+        old_rate_limiter = src.LoL.RATE_LIMITER
+        src.LoL.RATE_LIMITER = src.ratelimit.RateLimiter()
+        src.LoL.RATE_LIMITER.set_limits("EUW", [(20, 1), (100, 100)])
+        try:
+            watchlist = [("EUW", str(index)) for index in range(10)]
+            self.assertEqual(4, src.watchlist.Watcher(watchlist, None, 1, 0.25).spacing("EUW"))
+            self.assertEqual(6, src.watchlist.Watcher(watchlist, None, 60, 0.25).spacing("EUW"))
+        finally:
+            src.LoL.RATE_LIMITER = old_rate_limiter
+
+class AssetsTests(unittest.TestCase):
+    """Tests the fingerprinted and precompressed static assets"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.old_build_dir = src.assets.BUILD_DIR
+        src.assets.BUILD_DIR = os.path.join(self.directory, "build")
+        self.manifest = src.assets.build(target=src.assets.BUILD_DIR)
+        self.client = src.app.APP.test_client()
+
+    def tearDown(self):
+        src.assets.BUILD_DIR = self.old_build_dir
+        shutil.rmtree(self.directory)
+
+    def test_fingerprinted_names(self):
+        """Tests that names carry a hash of the content, before the extension"""
+        name = self.manifest["jquery-3.2.1.min.js"]
+        self.assertRegexpMatches(name, r"^jquery-3\.2\.1\.[0-9a-f]{12}\.min\.js$")
+        with open(os.path.join(src.assets.STATIC_DIR, "jquery-3.2.1.min.js"), "rb") as asset:
+            self.assertEqual(name, src.assets.fingerprinted("jquery-3.2.1.min.js", asset.read()))
+
+    def test_index_points_to_assets(self):
+        """Tests that the index references the fingerprinted assets and isn't cached"""
+        resp = self.client.get("/")
+        self.assertIn('src="assets/' + self.manifest["script.js"] + '"', resp.data)
+        self.assertIn('"images/Mastery_7.png": "assets/' + self.manifest["images/Mastery_7.png"],
+                      resp.data)
+        self.assertTrue(resp.cache_control.no_cache)
+
+    def test_immutable_asset(self):
+        """Tests that assets are cached forever and served precompressed when accepted"""
+        url = "/assets/" + self.manifest["script.js"]
+        plain = self.client.get(url)
+        compressed = self.client.get(url, headers={"Accept-Encoding" : "gzip"})
+        self.assertIn("immutable", compressed.headers["Cache-Control"])
+        self.assertEqual(src.app.ASSETS_MAX_AGE, compressed.cache_control.max_age)
+        self.assertEqual("gzip", compressed.headers["Content-Encoding"])
+        self.assertIn("javascript", compressed.mimetype)
+        self.assertEqual(plain.data, zlib.decompress(compressed.data, 16 + zlib.MAX_WBITS))
+        plain.close()
+        compressed.close()
+
+    def test_images_not_compressed(self):
+        """Tests that already compressed formats have no compressed variant"""
+        resp = self.client.get("/assets/" + self.manifest["images/katarina.gif"],
+                               headers={"Accept-Encoding" : "gzip"})
+        self.assertEqual(200, resp.status_code)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        resp.close()
+
+class SingleFlightTests(unittest.TestCase):
+    """Tests the coalescing of concurrent identical calls"""
+
+    def setUp(self):
+        self.flights = src.singleflight.SingleFlight()
+        self.release = threading.Event()
+        self.calls = []
+
+    def blocking_call(self, value):
+        """Blocks until released, then returns the value or fails if negative"""
+        self.calls.append(value)
+        self.release.wait(1)
+        if value < 0:
+            raise src.LoL.ApiError("Call failed")
+        return value
+
+    def run_concurrently(self, value, callers):
+        """Runs the same call from several threads, returning their outcomes"""
+        outcomes = []
+        def caller():
+            """Stores the outcome of a single caller"""
+            try:
+                outcomes.append(self.flights.do("key", self.blocking_call, value))
+            except src.LoL.ApiError as ex:
+                outcomes.append(ex)
+        threads = [threading.Thread(target=caller) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        while self.flights.in_flight() == 0:
+            time.sleep(0.001)
+        time.sleep(0.05)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_concurrent_calls_share_result(self):
+        """Tests that concurrent calls with the same key only run once"""
+        self.assertEqual([5] * 5, self.run_concurrently(5, 5))
+        self.assertEqual(1, len(self.calls))
+
+    def test_concurrent_calls_share_error(self):
+        """Tests that the exception of the call is raised to every caller"""
+        outcomes = self.run_concurrently(-1, 3)
+        self.assertEqual(3, len(outcomes))
+        self.assertTrue(all(isinstance(ex, src.LoL.ApiError) for ex in outcomes))
+        self.assertEqual(1, len(self.calls))
+
+    def test_sequential_calls_not_shared(self):
+        """Tests that a key can be called again once its call finished"""
+        self.release.set()
+        self.flights.do("key", self.blocking_call, 1)
+        self.flights.do("key", self.blocking_call, 2)
+        self.assertEqual([1, 2], self.calls)
+
+class SessionTests(unittest.TestCase):
+    """Tests the pooled connections to the API hosts"""
+
+    def tearDown(self):
+        src.sessions.close_all()
+
+    def test_session_reused_per_host(self):
+        """Tests that the same host always gets the same session"""
+        first = src.sessions.get_session("euw1.api.riotgames.com")
+        second = src.sessions.get_session("euw1.api.riotgames.com")
+        self.assertIs(first, second)
+
+    def test_session_per_region(self):
+        """Tests that different regional hosts get separate sessions"""
+        euw = src.sessions.get_session("euw1.api.riotgames.com")
+        korea = src.sessions.get_session("kr1.api.riotgames.com")
+        self.assertIsNot(euw, korea)
+
+class MockResponse(object):
+    """Mocks a response from the LoL API"""
+
+    def __init__(self, status_code, payload, headers=None):
+        self.status_code = status_code
+        self.payload = payload
+        self.headers = headers or {}
+
+    def json(self):
+        """Returns the payload"""
+        return self.payload
+
+class ChampionsPreloadTests(unittest.TestCase):
+    """Tests the bulk loading of the champion catalog"""
+
+    def setUp(self):
+        self.added = {}
+        self.old_add_champion_names = src.cache.add_champion_names
+        src.cache.add_champion_names = self.added.update
+        self.old_api_key_query = src.LoL.api_key_query
+        src.LoL.api_key_query = mock_api_key_query
+        self.old_scheduled_get = src.LoL.scheduled_get
+        src.LoL.scheduled_get = self.mock_scheduled_get
+
+    def tearDown(self):
+        src.cache.add_champion_names = self.old_add_champion_names
+        src.LoL.api_key_query = self.old_api_key_query
+        src.LoL.scheduled_get = self.old_scheduled_get
+
+    def mock_scheduled_get(self, region, method, url, params):
+        """Returns the champion list, which must be requested by ID"""
+        self.assertEqual("true", params["dataById"])
+        return MockResponse(200, {"data" : {"4" : {"id" : 4, "name" : "Twisted Fate"},
+                                            "78" : {"id" : 78, "name" : "Poppy"}}})
+
+    def test_preload_adds_all_champions(self):
+        """Tests that the whole catalog is added to the cache at once"""
+        self.assertEqual(2, src.champions.preload("NA"))
+        self.assertEqual({"4" : "Twisted Fate", "78" : "Poppy"}, self.added)
+
+class MockedRequestsTestCase(unittest.TestCase):
+    """Replaces the HTTP calls to the LoL API with queued responses."""
+
+    def setUp(self):
+        self.responses = []
+        self.calls = []
+        src.cache.ACCOUNTS.clear()
+        self.old_rate_limiter = src.LoL.RATE_LIMITER
+        src.LoL.RATE_LIMITER = src.ratelimit.RateLimiter()
+        self.old_api_key_query = src.LoL.api_key_query
+        src.LoL.api_key_query = mock_api_key_query
+        self.old_request_get = src.LoL.request_get
+        src.LoL.request_get = self.mock_request_get
+        src.resilience.reset()
+
+    def tearDown(self):
+        src.resilience.reset()
+        src.LoL.RATE_LIMITER = self.old_rate_limiter
+        src.LoL.api_key_query = self.old_api_key_query
+        src.LoL.request_get = self.old_request_get
+
+    def mock_request_get(self, url, params, stream=False, read_timeout=None):
+        """Returns the next queued response"""
+        self.calls.append(url)
+        return self.responses.pop(0)
+
+class RateLimitTests(MockedRequestsTestCase):
+    """Tests the scheduling of calls within the rate limits"""
+
+    def test_calls_queue_for_tokens(self):
+        """Tests that calls over the limit get a wait time instead of failing"""
+        limiter = src.ratelimit.RateLimiter()
+        limiter.set_limits("key", [(2, 1)])
+        self.assertEqual((True, 0.0), limiter.reserve(["key"], 1))
+        self.assertEqual((True, 0.0), limiter.reserve(["key"], 1))
+        granted, wait = limiter.reserve(["key"], 1)
+        self.assertTrue(granted)
+        self.assertAlmostEqual(0.5, wait, places=1)
+
+    def test_wait_over_budget_is_rejected(self):
+        """Tests that a call which can't be scheduled in time doesn't take a token"""
+        limiter = src.ratelimit.RateLimiter()
+        limiter.set_limits("key", [(1, 10)])
+        limiter.reserve(["key"], 1)
+        granted, wait = limiter.reserve(["key"], 1)
+        self.assertFalse(granted)
+        self.assertGreater(wait, 9)
+        self.assertAlmostEqual(-0.0, limiter.buckets["key"][0].tokens, places=1)
+
+    def test_limits_from_headers(self):
+        """Tests that limits reported by the API replace the configured ones"""
+        headers = {"X-App-Rate-Limit" : "10:1,500:600", "X-Method-Rate-Limit" : "5:10"}
+        self.responses = [MockResponse(200, {"accountId" : 7}, headers)]
+        src.LoL.get_account_id("EUW", "someSummoner")
+        limits = src.LoL.RATE_LIMITER.limits
+        self.assertEqual([(10, 1), (500, 600)], limits["EUW"])
+        self.assertIn([(5, 10)], limits.values())
+
+    def test_limits_shared_between_workers(self):
+        """Tests that worker processes sharing the database share the tokens and blocks"""
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "shared.sqlite")
+            workers = [src.ratelimit.SharedRateLimiter(path) for _ in range(2)]
+            for limiter in workers:
+                limiter.set_limits("EUW", [(4, 10)])
+            granted = [limiter.reserve(["EUW"], 0)[0] for limiter in workers * 3]
+            self.assertEqual([True] * 4 + [False] * 2, granted)
+            workers[0].set_limits("NA", [(4, 10)])
+            workers[1].set_limits("NA", [(4, 10)])
+            workers[0].block("NA", 100)
+            granted, wait = workers[1].reserve(["NA"], 1)
+            self.assertFalse(granted)
+            self.assertGreater(wait, 90)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_shared_limits_unavailable(self):
+        """Tests that a worker uses its own buckets if the database can't be opened"""
+        limiter = src.ratelimit.SharedRateLimiter(os.path.join("missing", "dir", "db.sqlite"))
+        limiter.set_limits("EUW", [(1, 10)])
+        self.assertTrue(limiter.reserve(["EUW"], 0)[0])
+        self.assertFalse(limiter.reserve(["EUW"], 0)[0])
+
+    def test_retry_after_rate_limited(self):
+        """Tests that a 429 is retried after the time in 'Retry-After'"""
+        self.responses = [MockResponse(429, {}, {"Retry-After" : "0"}),
+                          MockResponse(200, {"accountId" : 7})]
+        self.assertEqual(7, src.LoL.get_account_id("EUW", "someSummoner"))
+        self.assertEqual(2, len(self.calls))
+
+    def test_rate_limited_beyond_max_wait(self):
+        """Tests that a 429 with a long 'Retry-After' fails without retrying"""
+        self.responses = [MockResponse(429, {}, {"Retry-After" : "100",
+                                                 "X-Rate-Limit-Type" : "application"})]
+        with self.assertRaises(src.LoL.RateLimitError) as raised:
+            src.LoL.get_account_id("EUW", "someSummoner")
+        self.assertGreater(raised.exception.retry_after, 90)
+        self.assertEqual(1, len(self.calls))
+
+    def test_rate_limit_api_error(self):
+        """Tests that exhausted rate limits return a 429 with 'Retry-After'"""
+        self.responses = [MockResponse(429, {}, {"Retry-After" : "100"})]
+        with self.assertRaises(src.app.APIError) as raised:
+            src.app.get_game_data("EUW", "someSummoner")
+        self.assertEqual(429, raised.exception.status_code)
+        self.assertGreater(raised.exception.retry_after, 90)
+
+class ResilienceTests(MockedRequestsTestCase):
+    """Tests the protections isolating the regions from each other"""
+
+    def test_unhealthy_region_fails_fast(self):
+        """Tests that a region failing repeatedly returns a 503 without calling it,
+        while the other regions are still called"""
+        self.responses = [MockResponse(500, {"status" : {"message" : "Down"}})
+                          for _ in range(5)] + [MockResponse(200, {"accountId" : 7})]
+        for _ in range(5):
+            with self.assertRaises(src.LoL.ApiError):
+                src.LoL.get_account_id("KR", "someSummoner")
+        with self.assertRaises(src.app.APIError) as raised:
+            src.app.get_game_data("KR", "someSummoner")
+        self.assertEqual(503, raised.exception.status_code)
+        self.assertGreater(raised.exception.retry_after, 0)
+        self.assertEqual(5, len(self.calls))
+        self.assertEqual(7, src.LoL.get_account_id("EUW", "someSummoner"))
+
+    def test_circuit_breaker(self):
+        """Tests that the circuit opens on failures and a trial call closes it"""
+        breaker = src.resilience.CircuitBreaker(2, 0)
+        breaker.record(False)
+        self.assertFalse(breaker.is_open())
+        breaker.record(False)
+        self.assertTrue(breaker.is_open())
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(True)
+        self.assertFalse(breaker.is_open())
+        self.assertTrue(breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        """Tests that a failing trial call opens the circuit for another cooldown"""
+        breaker = src.resilience.CircuitBreaker(1, 60)
+        breaker.record(False)
+        breaker.opened_at -= 60
+        self.assertTrue(breaker.allow())
+        breaker.record(False)
+        self.assertFalse(breaker.allow())
+        self.assertGreater(breaker.retry_after(), 59)
+
+    def test_bulkhead(self):
+        """Tests that calls over the limit wait and then fail"""
+        bulkhead = src.resilience.Bulkhead(1)
+        self.assertTrue(bulkhead.acquire(0))
+        self.assertFalse(bulkhead.acquire(0.01))
+        bulkhead.release()
+        self.assertTrue(bulkhead.acquire(0))
+
+    def test_adaptive_read_timeout(self):
+        """Tests that the read timeout follows the tail latency within bounds"""
+        guard = src.resilience.RegionGuard("EUW")
+        self.assertEqual(guard.max_read_timeout, guard.read_timeout("match"))
+        for _ in range(50):
+            guard.record(True, 0.5, "match")
+        self.assertAlmostEqual(1.5, guard.read_timeout("match"))
+        for _ in range(src.resilience.LATENCY_WINDOW):
+            guard.record(True, 0.01, "match")
+        self.assertEqual(src.resilience.MIN_READ_TIMEOUT, guard.read_timeout("match"))
+
+    def test_read_timeout_per_method(self):
+        """Tests that fast methods don't shorten the read timeout of slow ones"""
+        guard = src.resilience.RegionGuard("EUW")
+        for _ in range(src.resilience.LATENCY_WINDOW):
+            guard.record(True, 0.01, "mastery")
+        for _ in range(10):
+            guard.record(True, 2, "match")
+        self.assertEqual(src.resilience.MIN_READ_TIMEOUT, guard.read_timeout("mastery"))
+        self.assertEqual(guard.max_read_timeout, guard.read_timeout("match"))
+
+    def test_hedged_call(self):
+        """Tests that a slow call is sent again and the first reply wins"""
+        guard = src.resilience.RegionGuard("EUW")
+        delays = [0.2, 0]
+        discarded = []
+        def call():
+            """Replies after the next delay"""
+            delay = delays.pop(0)
+            time.sleep(delay)
+            return delay
+        self.assertEqual(0, guard.first_of(call, 0.01, lambda: True, discarded.append))
+        deadline = time.time() + 1
+        while not discarded and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual([0.2], discarded)
+
+    def test_hedge_not_allowed(self):
+        """Tests that a slow call is awaited when hedging isn't allowed"""
+        guard = src.resilience.RegionGuard("EUW")
+        self.assertEqual(1, guard.first_of(lambda: 1, 0, lambda: False, None))
+
 if __name__ == '__main__':
     API_SUITE = unittest.TestLoader().loadTestsFromTestCase(APITests)
     unittest.TextTestRunner(verbosity=2).run(API_SUITE)
+    STREAM_API_SUITE = unittest.TestLoader().loadTestsFromTestCase(StreamAPITests)
+    unittest.TextTestRunner(verbosity=2).run(STREAM_API_SUITE)
+    BATCH_API_SUITE = unittest.TestLoader().loadTestsFromTestCase(BatchAPITests)
+    unittest.TextTestRunner(verbosity=2).run(BATCH_API_SUITE)
+    ASYNC_API_SUITE = unittest.TestLoader().loadTestsFromTestCase(AsyncAPITests)
+    unittest.TextTestRunner(verbosity=2).run(ASYNC_API_SUITE)
     CACHE_SUITE = unittest.TestLoader().loadTestsFromTestCase(CacheTests)
     unittest.TextTestRunner(verbosity=2).run(CACHE_SUITE)
+    FAKE_RIOT_SUITE = unittest.TestLoader().loadTestsFromTestCase(FakeRiotTests)
+    unittest.TextTestRunner(verbosity=2).run(FAKE_RIOT_SUITE)
+    METRICS_SUITE = unittest.TestLoader().loadTestsFromTestCase(MetricsTests)
+    unittest.TextTestRunner(verbosity=2).run(METRICS_SUITE)
+    PARALLEL_SUITE = unittest.TestLoader().loadTestsFromTestCase(ParallelTests)
+    unittest.TextTestRunner(verbosity=2).run(PARALLEL_SUITE)
+    STORE_SUITE = unittest.TestLoader().loadTestsFromTestCase(ChampionStoreTests)
+    unittest.TextTestRunner(verbosity=2).run(STORE_SUITE)
+    MATCH_PARSER_SUITE = unittest.TestLoader().loadTestsFromTestCase(MatchParserTests)
+    unittest.TextTestRunner(verbosity=2).run(MATCH_PARSER_SUITE)
+    MATCH_STORE_SUITE = unittest.TestLoader().loadTestsFromTestCase(MatchStoreTests)
+    unittest.TextTestRunner(verbosity=2).run(MATCH_STORE_SUITE)
+    TTL_CACHE_SUITE = unittest.TestLoader().loadTestsFromTestCase(TTLCacheTests)
+    unittest.TextTestRunner(verbosity=2).run(TTL_CACHE_SUITE)
+    SHARED_CACHE_SUITE = unittest.TestLoader().loadTestsFromTestCase(SharedCacheTests)
+    unittest.TextTestRunner(verbosity=2).run(SHARED_CACHE_SUITE)
+    WATCHLIST_SUITE = unittest.TestLoader().loadTestsFromTestCase(WatchlistTests)
+    unittest.TextTestRunner(verbosity=2).run(WATCHLIST_SUITE)
+    RESILIENCE_SUITE = unittest.TestLoader().loadTestsFromTestCase(ResilienceTests)
+    unittest.TextTestRunner(verbosity=2).run(RESILIENCE_SUITE)
+    ASSETS_SUITE = unittest.TestLoader().loadTestsFromTestCase(AssetsTests)
+    unittest.TextTestRunner(verbosity=2).run(ASSETS_SUITE)
+    SINGLE_FLIGHT_SUITE = unittest.TestLoader().loadTestsFromTestCase(SingleFlightTests)
+    unittest.TextTestRunner(verbosity=2).run(SINGLE_FLIGHT_SUITE)
+    SESSION_SUITE = unittest.TestLoader().loadTestsFromTestCase(SessionTests)
+    unittest.TextTestRunner(verbosity=2).run(SESSION_SUITE)
+    PRELOAD_SUITE = unittest.TestLoader().loadTestsFromTestCase(ChampionsPreloadTests)
+    unittest.TextTestRunner(verbosity=2).run(PRELOAD_SUITE)
+    RATE_LIMIT_SUITE = unittest.TestLoader().loadTestsFromTestCase(RateLimitTests)
+    unittest.TextTestRunner(verbosity=2).run(RATE_LIMIT_SUITE)
 
-#TODO Mock all possible responses from the LoL API and test all LoL.py methods
-#TODO Test responses with rate limits
-#TODO Test methods in cache.py